@@ -0,0 +1,156 @@
+"""Asynchronous (ASGI) serving of map tiles.
+
+A synchronous Flask view holds a worker thread for the whole life of a
+tile request, so concurrent connections are bounded by threads. Here
+tile requests are handled on an event loop instead: the cheap, I/O-bound
+stages (statting the dataset, looking the tile up in the cache) run off
+the loop without blocking it, and only cache misses take a thread from a
+bounded rendering pool, once for all the concurrent requests for the
+same tile. When more renders are waiting than the queue allows, requests
+are turned away at once with 503 and Retry-After rather than piling up.
+
+Requests for anything other than tiles are passed to a fallback ASGI
+application, normally the Flask/Dash server behind asgiref's WsgiToAsgi
+(see `Maproom.asgi`).
+"""
+import asyncio
+import concurrent.futures
+import json
+import os
+import re
+import urllib.parse
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+
+import pingrid
+
+TILE_PATH = re.compile(r"/tile-(\d+)/(\d+)/(\d+)/(\d+)")
+
+
+class TileApp:
+    """ASGI application serving the tiles of the views `views` (made by
+    `common.tile_wrap`) at /tile-{i}/{z}/{x}/{y}, and passing other
+    requests on to the ASGI application `fallback`.
+
+    Tiles are rendered by `workers` threads (default is one per CPU);
+    when `queue` renders are already waiting for one, further requests
+    get 503 with a Retry-After of `retry_after` seconds.
+    """
+    def __init__(self, views, fallback=None, workers=None, queue=64, retry_after=1):
+        self.views = views
+        self.fallback = fallback
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.retry_after = retry_after
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix="tile"
+        )
+        # renders submitted and not finished, and the futures of their
+        # results by tile digest; only touched on the loop
+        self._pending = 0
+        self._flights = dict()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            m = TILE_PATH.fullmatch(scope["path"])
+            if m is not None and int(m[1]) < len(self.views):
+                await self.tile(scope, send, *(int(g) for g in m.groups()))
+                return
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if self.fallback is None:
+            await self.respond(send, 404, b"not found", "text/plain")
+            return
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def tile(self, scope, send, i, tz, tx, ty):
+        view = self.views[i]
+        qstring = scope["query_string"].decode("latin-1")
+        query = urllib.parse.parse_qsl(qstring, keep_blank_values=True)
+
+        try:
+            digest, entry, bbox = await asyncio.to_thread(
+                view.locate, tz, tx, ty, query
+            )
+            if digest in parse_etags(_header(scope, b"if-none-match")):
+                await self.respond_tile(send, view, digest, None)
+                return
+            if entry is None:
+                await self.respond_tile(
+                    send, view, digest, pingrid.empty_tile_bytes(view.encoding)
+                )
+                return
+
+            buf = await asyncio.to_thread(view.cache.get, digest)
+            if buf is None and digest in self._flights:
+                # the same tile is being rendered for another request
+                buf = await asyncio.shield(self._flights[digest])
+            elif buf is None:
+                # as lenient as flask.request.args, which the Flask
+                # route reads them from
+                args = MultiDict(query)
+                args = [pingrid.parse_arg(p, args=args) for p in view.params]
+                if self._pending >= self.workers + self.queue:
+                    await self.respond(
+                        send, 503, b"too many tiles being rendered", "text/plain",
+                        [(b"retry-after", str(self.retry_after).encode())],
+                    )
+                    return
+                self._pending += 1
+                flight = self._flights[digest] = asyncio.get_running_loop().run_in_executor(
+                    self._pool, view.fill, digest, entry, args, tx, ty, tz, bbox,
+                    query,
+                )
+                try:
+                    buf = await asyncio.shield(flight)
+                finally:
+                    self._pending -= 1
+                    del self._flights[digest]
+        except pingrid.ClientSideError as e:
+            await self.respond(
+                send, e.status, json.dumps(e.to_dict()).encode(), "application/json"
+            )
+            return
+        await self.respond_tile(send, view, digest, buf)
+
+    async def respond_tile(self, send, view, digest, buf):
+        headers = [
+            (b"etag", f'"{digest}"'.encode()),
+            (b"cache-control", view.cache.cache_control.encode()),
+        ]
+        if buf is None:
+            await self.respond(send, 304, b"", view.encoding.mimetype, headers)
+        else:
+            await self.respond(send, 200, buf, view.encoding.mimetype, headers)
+
+    async def respond(self, send, status, body, mimetype, headers=()):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", mimetype.encode()),
+                (b"content-length", str(len(body)).encode()),
+                *headers,
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def _header(scope, name):
+    for k, v in scope["headers"]:
+        if k == name:
+            return v.decode("latin-1")
+    return None
+
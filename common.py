@@ -1,4 +1,17 @@
+import concurrent.futures
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+import types
 import uuid
+import flask
+import numpy as np
+import plotly.utils
 import xarray as xr
 import pingrid
 import urllib
@@ -39,10 +52,12 @@ class CallbackRegistry:
         self.defs = []
 
 
-    def add(self, function, output, prop):
+    def add(self, function, output, prop, data=None, cache=False):
         self.defs.append({ 'function': function,
                            'output': output,
-                           'prop': prop
+                           'prop': prop,
+                           'data': data,
+                           'cache': cache,
                          })
 
 
@@ -69,38 +84,695 @@ def tile_url(prefix):
         return f"/{prefix}/{{z}}/{{x}}/{{y}}?{qstr}"
     return url
 
-def tile_wrap(path, function):
-    def tile(tz, tx, ty):
-        x_min = pingrid.tile_left(tx, tz)
-        x_max = pingrid.tile_left(tx + 1, tz)
-        # row numbers increase as latitude decreases
-        y_max = pingrid.tile_top_mercator(ty, tz)
-        y_min = pingrid.tile_top_mercator(ty + 1, tz)
+def file_version(path):
+    """Returns the (mtime, size) of the file at `path`, or None if `path`
+    is not a local file (e.g. an OPeNDAP URL).
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def grid_of(data, dim_x="X", dim_y="Y"):
+    if dim_x in data.coords and dim_y in data.coords:
+        return pingrid.Grid.from_coords(data[dim_x].values, data[dim_y].values)
+    return None
+
+
+class DatasetPool:
+    """Process-wide pool of open datasets, keyed by path.
+
+    Each dataset is opened once and reused across requests. Every lookup
+    stats the file, and the dataset is reopened when its mtime or size
+    changed, so data refreshed on disk is picked up without a restart.
+
+    Entries are dicts holding the dataset (`data`), the file version it
+    was opened at (`version`) and, for datasets with X and Y coordinates,
+    a `pingrid.Grid` describing them (`grid`).
+
+    `chunks` is passed on to the opener to get a dask-backed dataset;
+    "tiles" stands for `pingrid.tile_chunks` of the dataset. The same
+    path opened with different chunks makes separate entries.
+    """
+    def __init__(self, opener=xr.open_dataset):
+        self._opener = opener
+        self._entries = dict()
+        # guards _entries and _opening; datasets are opened outside of
+        # it, under the lock of their key in _opening, so that opening
+        # one doesn't hold up requests for the others
+        self._lock = threading.Lock()
+        self._opening = dict()
+
+    def _open(self, path, chunks):
+        if chunks is None:
+            return self._opener(path)
+        if chunks == "tiles":
+            with self._opener(path) as probe:
+                chunks = pingrid.tile_chunks(probe)
+        return self._opener(path, chunks=chunks)
+
+    def get(self, path, chunks=None):
+        version = file_version(path)
+        key = (path, chunks if not isinstance(chunks, dict) else tuple(sorted(chunks.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['version'] == version:
+                return entry
+            opening = self._opening.setdefault(key, threading.Lock())
+        with opening:
+            # a request that held the key's lock may have just opened it
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and entry['version'] == version:
+                return entry
+            # The replaced dataset is not closed explicitly: requests
+            # still holding it may be reading from it. xarray closes
+            # the file once the last reference is gone.
+            data = self._open(path, chunks)
+            entry = {
+                'data': data,
+                'version': version,
+                'grid': grid_of(data),
+            }
+            with self._lock:
+                self._entries[key] = entry
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # locks held by other threads at a fork stay held in the child
+            self._opening = dict()
+
 
-        data = xr.open_dataset(path)
+DATASETS = DatasetPool()
 
-        if (
-                x_min > data['X'].max() or
-                x_max < data['X'].min() or
-                y_min > data['Y'].max() or
-                y_max < data['Y'].min()
-        ):
-            return pingrid.image_resp(pingrid.empty_tile())
 
-        res = data['X'][1].item() - data['X'][0].item()
+class TileCache:
+    """Cache of encoded tiles, with an in-memory LRU tier bounded by
+    `max_bytes` and an optional on-disk tier under `directory` bounded by
+    `max_disk_bytes`.
 
-        data = data.sel(
-            X=slice(x_min - x_min % res, x_max + res - x_max % res),
-            Y=slice(y_min - y_min % res, y_max + res - y_max % res),
-        ).compute()
+    Keys are tuples of primitive values; they are hashed into a digest
+    that names the file on disk and doubles as the tile's ETag.
+    `max_age` is the lifetime in seconds advertised to browsers and
+    proxies through Cache-Control. With the default, None, they keep
+    tiles but revalidate them with the ETag on every use: tile URLs
+    don't change when the data is refreshed.
 
-        args = []
-        for p in list(signature(function).parameters.keys())[1:]:
-            args.append(pingrid.parse_arg(p))
+    The disk tier is pruned of its least recently used tiles once this
+    process has written past `max_disk_bytes`, down to 90% of it.
+    Processes sharing a directory each prune it, so it may overshoot by
+    what the others wrote since they last did. None leaves it unbounded,
+    to be pruned from outside.
+    """
+    def __init__(self, max_bytes=256 * 2**20, directory=None, max_age=None,
+                 max_disk_bytes=4 * 2**30):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = pingrid.LRUCache(max_bytes)
+        # bytes on disk as of the last prune, plus those written since
+        self._disk_bytes = None
+        self._disk_lock = threading.Lock()
 
-        tile = function(data, *args).rename({'X': "lon", 'Y': "lat"})
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
 
-        result = pingrid.tile(tile, tx, ty, tz, None) # add clipping
+    @property
+    def cache_control(self):
+        if self.max_age is None:
+            return "public, no-cache"
+        return f"public, max-age={self.max_age}"
 
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, digest):
+        buf = self._memory.get(digest)
+        if buf is None and self.directory is not None:
+            path = self._path(digest)
+            try:
+                with open(path, "rb") as f:
+                    buf = f.read()
+                # mtimes order the tiles for pruning
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            self._memory.put(digest, buf)
+        return buf
+
+    def put(self, digest, buf):
+        self._memory.put(digest, buf)
+        if self.directory is not None:
+            path = self._path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so that readers never see a partial tile
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf)
+            os.replace(tmp, path)
+            if self.max_disk_bytes is not None:
+                with self._disk_lock:
+                    if self._disk_bytes is None:
+                        self._disk_bytes = sum(n for _, n, _ in self._disk_files())
+                    else:
+                        self._disk_bytes += len(buf)
+                    if self._disk_bytes > self.max_disk_bytes:
+                        self.prune(self.max_disk_bytes * 9 // 10)
+
+    def _disk_files(self):
+        # (mtime, size, path) of the tiles on disk
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for n in names:
+                if n.startswith("tmp"):
+                    # being written
+                    continue
+                path = os.path.join(root, n)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, path))
+        return files
+
+    def prune(self, max_bytes=0):
+        """Removes the least recently used tiles from the disk tier until
+        it holds no more than `max_bytes`.
+        """
+        files = sorted(self._disk_files())
+        total = sum(n for _, n, _ in files)
+        for _, n, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # pruned by another process
+                pass
+            total -= n
+        self._disk_bytes = total
+
+    def clear(self):
+        self._memory.clear()
+
+    def response(self, digest, buf, mimetype="image/png"):
+        resp = flask.Response(buf, mimetype=mimetype)
+        resp.set_etag(digest)
+        resp.headers["Cache-Control"] = self.cache_control
+        return resp.make_conditional(flask.request)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: while a call for a
+    key is running, other calls for that key wait for it and get its
+    result (or exception) instead of running again.
+    """
+    def __init__(self):
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return call.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
         return result
+
+
+def coalesced(function):
+    """Wraps `function` so that concurrent calls with equal arguments run
+    it once (see SingleFlight). Arguments are compared by repr, so they
+    need not be hashable.
+    """
+    flights = SingleFlight()
+
+    @functools.wraps(function)
+    def wrapped(*args, **kwargs):
+        key = repr((args, sorted(kwargs.items())))
+        return flights.do(key, function, *args, **kwargs)
+    return wrapped
+
+
+class CallbackCache:
+    """Results of Dash callbacks, keyed on their inputs.
+
+    Results are kept up to `max_bytes` of their JSON encoding, which is
+    what Dash sends, least recently used first out, and a result is
+    recomputed once it is older than `ttl` seconds.
+    Callbacks that read a dataset are keyed on its file version as well,
+    so results are recomputed when the data is refreshed on disk.
+    """
+    def __init__(self, max_bytes=64 * 2**20, ttl=600):
+        self.ttl = ttl
+        self._results = pingrid.LRUCache(max_bytes, sizeof=_json_size)
+        self._flights = SingleFlight()
+
+    def clear(self):
+        self._results.clear()
+
+    def wrap(self, function, name, markers=(), data=None):
+        """Wraps the callback `function`, cached under `name`.
+
+        `markers` are the names of the arguments that are marker
+        positions. With `data`, the path of the dataset the callback
+        reads, positions are snapped to the dataset's grid cell with
+        `pingrid.sel_snap`, so that every position within a cell shares
+        the result computed for the first one.
+        """
+        @functools.wraps(function)
+        def wrapped(**kwargs):
+            key = [name]
+            if data is not None:
+                entry = DATASETS.get(data)
+                key.append(entry['version'])
+            for k, v in sorted(kwargs.items()):
+                if k in markers and data is not None:
+                    v = snap_position(entry['data'], v)
+                key.append((k, repr(v)))
+            key = tuple(key)
+
+            def compute():
+                hit = self._results.get(key)
+                if hit is not None and time.monotonic() - hit[0] < self.ttl:
+                    return hit[1]
+                result = function(**kwargs)
+                self._results.put(key, (time.monotonic(), result))
+                return result
+            return self._flights.do(key, compute)
+        return wrapped
+
+
+def _json_size(hit):
+    # size of a (time, result) entry of CallbackCache, figures and
+    # components included
+    try:
+        return len(json.dumps(hit[1], cls=plotly.utils.PlotlyJSONEncoder))
+    except (TypeError, ValueError):
+        return len(repr(hit[1]))
+
+
+def snap_position(data, position, dim_x="X", dim_y="Y"):
+    """Returns the (lat, lng) of the center of the cell of `data`'s grid
+    that the marker `position` falls in, or `position` unchanged if it is
+    outside the grid.
+    """
+    if isinstance(position, dict):
+        lat, lng = position["lat"], position["lng"]
+    else:
+        lat, lng = position
+    coords = xr.Dataset(coords={dim_x: data[dim_x], dim_y: data[dim_y]})
+    try:
+        cell = pingrid.sel_snap(coords, lat, lng, dim_y, dim_x)
+    except KeyError:
+        return position
+    return (cell[dim_y].item(), cell[dim_x].item())
+
+
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def dask_scheduler(name):
+    """Translates a scheduler name into the value of dask's `scheduler`
+    argument. "threads", "processes" and "synchronous" are dask's local
+    schedulers; "distributed" starts a local distributed cluster in this
+    process on first use (requires dask.distributed). None is dask's
+    default.
+    """
+    if name != "distributed":
+        return name
+    pid = os.getpid()
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(pid)
+        if client is None:
+            try:
+                from dask.distributed import Client, LocalCluster
+            except ImportError as e:
+                raise MaproomException(
+                    "the distributed scheduler requires dask.distributed"
+                ) from e
+            client = _CLIENTS[pid] = Client(LocalCluster(processes=False))
+    return client
+
+
+def cut_tile(data, grid, x_min, y_min, x_max, y_max):
+    """Selects the part of `data` that a tile's bounding box overlaps,
+    plus a cell of margin.
+    """
+    if grid.regular:
+        x_slice, y_slice = grid.index_ranges(x_min, y_min, x_max, y_max)
+    else:
+        x_slice = _coord_range(data['X'].values, x_min, x_max)
+        y_slice = _coord_range(data['Y'].values, y_min, y_max)
+    return data.isel(X=x_slice, Y=y_slice)
+
+
+def _coord_range(coord, v_min, v_max):
+    # index slice of the uneven coordinates within [v_min, v_max], plus
+    # the one beyond each end, and at least two
+    ascending = coord[-1] >= coord[0]
+    c = coord if ascending else coord[::-1]
+    start = max(np.searchsorted(c, v_min, side="left") - 1, 0)
+    stop = min(np.searchsorted(c, v_max, side="right") + 1, len(c))
+    if stop - start < 2:
+        start = max(min(start, len(c) - 2), 0)
+        stop = min(start + 2, len(c))
+    if not ascending:
+        start, stop = len(c) - stop, len(c) - start
+    return slice(int(start), int(stop))
+
+
+_ENCODERS = dict()
+_ENCODERS_LOCK = threading.Lock()
+
+
+def encoders():
+    """The pool encoding the tiles of metatiles, for all layers. There is
+    one per process: a pool inherited through a fork has no threads
+    left to run its tasks (e.g. in gunicorn workers, or seed's pool).
+    """
+    pid = os.getpid()
+    with _ENCODERS_LOCK:
+        pool = _ENCODERS.get(pid)
+        if pool is None:
+            pool = _ENCODERS[pid] = concurrent.futures.ThreadPoolExecutor(
+                os.cpu_count() or 1, thread_name_prefix="encode"
+            )
+    return pool
+
+
+def layer_fingerprint(function):
+    """Digest of the code of the layer function `function` and of the
+    colormaps in pingrid.CMAPS it may pick from, stable across restarts.
+    It is part of tile cache keys, so that tiles kept on disk aren't
+    served after either changed. Functions `function` calls aren't
+    looked into.
+    """
+    h = hashlib.sha1()
+
+    def feed(code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for c in code.co_consts:
+            if isinstance(c, types.CodeType):
+                feed(c)
+            elif isinstance(c, frozenset):
+                h.update(repr(sorted(c, key=repr)).encode())
+            else:
+                h.update(repr(c).encode())
+
+    function = inspect.unwrap(function)
+    code = getattr(function, "__code__", None)
+    if code is None:
+        h.update(function.__class__.__qualname__.encode())
+    else:
+        feed(code)
+        h.update(repr(function.__defaults__).encode())
+    for name, cs in sorted(pingrid.CMAPS.items()):
+        h.update(name.encode())
+        h.update(cs.colors.tobytes())
+        h.update(repr(cs.scale).encode())
+    return h.hexdigest()
+
+
+def tile_bbox(tx, ty, tz, nx=1, ny=1):
+    """The (x_min, y_min, x_max, y_max) bounding box of the `nx` by `ny`
+    tiles whose top left one is (tx, ty).
+    """
+    x_min = pingrid.tile_left(tx, tz)
+    x_max = pingrid.tile_left(tx + nx, tz)
+    # row numbers increase as latitude decreases
+    y_max = pingrid.tile_top_mercator(ty, tz)
+    y_min = pingrid.tile_top_mercator(ty + ny, tz)
+    return x_min, y_min, x_max, y_max
+
+
+def tile_wrap(path, function, cache=None, name=None, encoding=None,
+              results=None, chunks=None, scheduler=None, overview=None,
+              clipping=None, metatile=1):
+    """Makes the view function serving the tiles of a layer.
+
+    If `results` is an LRUCache, `function` is evaluated once per
+    distinct set of arguments over the whole dataset, the result is kept
+    in `results`, and tiles are cut from it. Otherwise `function` is
+    evaluated on each tile's slice of the dataset.
+
+    With `chunks` (see DatasetPool), the dataset is dask-backed and
+    `function` runs lazily; only its result is computed, with the dask
+    `scheduler` named (see dask_scheduler), reading just the chunks the
+    tile overlaps.
+
+    `overview(args, tz, version)` may return a precomputed result for
+    the tile's control values and zoom level as a (DataArray, Grid) pair
+    (see pyramid.overviews), which is then used instead of `function`.
+
+    `clipping` is passed on to `pingrid.tile_bytes`, preferably as a
+    `pingrid.ShapeClipper`.
+
+    Concurrent requests for the same tile are rendered once, all of them
+    getting the same bytes.
+
+    With `metatile` > 1, a tile missing from the cache is rendered with
+    the others of its `metatile` by `metatile` block that are missing:
+    the dataset is sliced and `function` evaluated once for the block,
+    and its tiles are encoded in parallel and all cached. Neighbouring
+    tiles, which a map requests together, then cost one read and one
+    call. `function` must give the same values on a block as on each of
+    its tiles, i.e. not depend on the extent of its slice.
+    """
+    if cache is None:
+        cache = TileCache(max_bytes=0)
+    if name is None:
+        name = function.__qualname__
+    if encoding is None:
+        encoding = pingrid.TileEncoding()
+    params = list(signature(function).parameters.keys())[1:]
+    fingerprint = layer_fingerprint(function)
+    flights = SingleFlight()
+
+    def tile_digest(entry, tz, tx, ty, query):
+        return cache.digest((
+            name, fingerprint, tz, tx, ty, tuple(sorted(query)),
+            entry['version'], tuple(encoding),
+        ))
+
+    def locate(tz, tx, ty, query):
+        """Returns the digest of a tile, given its query arguments as
+        (name, value) pairs, the dataset entry it is drawn from and its
+        bounding box. The entry is None if the tile is blank.
+        """
+        entry = DATASETS.get(path, chunks)
+        bbox = tile_bbox(tx, ty, tz)
+        if not entry['grid'].intersects(*bbox):
+            return cache.digest(("empty", tuple(encoding))), None, None
+        return tile_digest(entry, tz, tx, ty, query), entry, bbox
+
+    def tile(tz, tx, ty):
+        digest, entry, bbox = locate(
+            tz, tx, ty, flask.request.args.items(multi=True)
+        )
+        if entry is None:
+            return cache.response(
+                digest, pingrid.empty_tile_bytes(encoding), encoding.mimetype
+            )
+        if digest in flask.request.if_none_match:
+            return cache.response(digest, b"", encoding.mimetype)
+
+        buf = cache.get(digest)
+        if buf is None:
+            args = [pingrid.parse_arg(p) for p in params]
+            buf = fill(
+                digest, entry, args, tx, ty, tz, bbox,
+                flask.request.args.items(multi=True),
+            )
+        return cache.response(digest, buf, encoding.mimetype)
+
+    def fill(digest, entry, args, tx, ty, tz, bbox, query):
+        """Renders a tile missing from the cache and caches it, once for
+        all the concurrent requests for it.
+        """
+        if metatile > 1:
+            buf = fill_block(entry, args, tx, ty, tz, query).get(digest)
+            if buf is not None:
+                return buf
+
+        def produce():
+            # a request that just finished may have cached it
+            buf = cache.get(digest)
+            if buf is None:
+                buf = render(entry, args, tx, ty, tz, *bbox)
+                cache.put(digest, buf)
+            return buf
+        return flights.do(digest, produce)
+
+    def fill_block(entry, args, tx, ty, tz, query):
+        """Renders the tiles missing from the cache in the metatile of
+        tile (tx, ty) and caches them, once for all the concurrent
+        requests for tiles of the metatile. Returns them by digest.
+        """
+        query = tuple(sorted(query))
+        n = min(metatile, 2 ** tz)
+        mx = tx - tx % n
+        my = ty - ty % n
+
+        def produce():
+            missing = []
+            for sy in range(my, min(my + n, 2 ** tz)):
+                for sx in range(mx, min(mx + n, 2 ** tz)):
+                    if not entry['grid'].intersects(*tile_bbox(sx, sy, tz)):
+                        continue
+                    digest = tile_digest(entry, tz, sx, sy, query)
+                    if cache.get(digest) is None:
+                        missing.append((digest, sx, sy))
+            if len(missing) == 0:
+                return {}
+
+            # one slice covering the missing tiles
+            x0 = min(sx for _, sx, _ in missing)
+            y0 = min(sy for _, _, sy in missing)
+            x1 = max(sx for _, sx, _ in missing) + 1
+            y1 = max(sy for _, _, sy in missing) + 1
+            block = data_tile(entry, args, tz, *tile_bbox(x0, y0, tz, x1 - x0, y1 - y0))
+
+            def encode(missing_tile):
+                digest, sx, sy = missing_tile
+                buf = pingrid.tile_bytes(block, sx, sy, tz, clipping, encoding)
+                cache.put(digest, buf)
+                return digest, buf
+            return dict(encoders().map(encode, missing))
+
+        key = cache.digest((
+            name, fingerprint, "metatile", n, tz, mx, my, query,
+            entry['version'], tuple(encoding),
+        ))
+        return flights.do(key, produce)
+
+    def render(entry, args, tx, ty, tz, x_min, y_min, x_max, y_max):
+        tile = data_tile(entry, args, tz, x_min, y_min, x_max, y_max)
+        return pingrid.tile_bytes(tile, tx, ty, tz, clipping, encoding)
+
+    def data_tile(entry, args, tz, x_min, y_min, x_max, y_max):
+        level = None if overview is None else overview(args, tz, entry['version'])
+        if level is not None:
+            result, grid = level
+            tile = cut_tile(result, grid, x_min, y_min, x_max, y_max).compute()
+        elif results is None:
+            data = cut_tile(
+                entry['data'], entry['grid'], x_min, y_min, x_max, y_max
+            )
+            if chunks is None:
+                tile = function(data.compute(), *args)
+            else:
+                tile = function(data, *args).compute(
+                    scheduler=dask_scheduler(scheduler)
+                )
+        else:
+            key = (name, tuple(args), entry['version'])
+            memo = results.get(key)
+            if memo is None:
+                memo = flights.do(("memo",) + key, memoize, entry, args, key)
+            result, grid = memo
+            tile = cut_tile(result, grid, x_min, y_min, x_max, y_max)
+
+        return tile.rename({'X': "lon", 'Y': "lat"})
+
+    def memoize(entry, args, key):
+        """Evaluates `function` over the whole dataset and keeps the
+        result in `results`, once for all the concurrent tiles that need
+        it.
+        """
+        # a request that just finished may have kept it
+        memo = results.get(key)
+        if memo is None:
+            result = function(entry['data'], *args).compute(
+                scheduler=dask_scheduler(scheduler)
+            )
+            memo = (result, grid_of(result))
+            results.put(key, memo)
+        return memo
+
+    def value(tz, tx, ty, format):
+        """Serves the values of a tile (see pingrid.value_tile_bytes).
+        They don't depend on the tile encoding, so are cached apart from
+        the images. The cached bytes are the JSON of the headers, a
+        newline, then the tile.
+        """
+        if format not in pingrid.VALUE_FORMATS:
+            return pingrid.client_side_error(pingrid.NotFoundError(
+                f"value tiles are {', '.join(pingrid.VALUE_FORMATS)}"
+            ))
+        entry = DATASETS.get(path, chunks)
+        digest = cache.digest((
+            name, fingerprint, "values", format, tz, tx, ty,
+            tuple(sorted(flask.request.args.items(multi=True))), entry['version'],
+        ))
+        mimetype = pingrid.VALUE_FORMATS[format]
+        if digest in flask.request.if_none_match:
+            return cache.response(digest, b"", mimetype)
+
+        def produce(args):
+            buf = cache.get(digest)
+            if buf is None:
+                bbox = tile_bbox(tx, ty, tz)
+                tile = None
+                if entry['grid'].intersects(*bbox):
+                    tile = data_tile(entry, args, tz, *bbox)
+                body, headers = pingrid.value_tile_bytes(
+                    tile, tx, ty, tz, format, clipping
+                )
+                buf = json.dumps(headers).encode() + b"\n" + body
+                cache.put(digest, buf)
+            return buf
+
+        buf = cache.get(digest)
+        if buf is None:
+            args = [pingrid.parse_arg(p) for p in params]
+            buf = flights.do(digest, produce, args)
+        head, _, body = buf.partition(b"\n")
+        resp = cache.response(digest, body, mimetype)
+        resp.headers.update(json.loads(head))
+        return resp
+
+    # The stages of the view, for servers that run them separately
+    # (see asgi.TileApp).
+    tile.locate = locate
+    tile.fill = fill
+    tile.value = value
+    tile.params = params
+    tile.cache = cache
+    tile.encoding = encoding
     return tile
+
+
+def colormap_lut(name):
+    """Serves the 256-color LUT of the colormap `name` in pingrid.CMAPS
+    as JSON, for clients that colormap value tiles themselves (see
+    `tile_wrap`'s value view).
+    """
+    cs = pingrid.CMAPS.get(name)
+    if cs is None:
+        return pingrid.client_side_error(
+            pingrid.NotFoundError(f"there is no colormap `{name}`")
+        )
+    resp = flask.jsonify(name=name, colors=cs.to_dash_leaflet(lutsize=256))
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 86400
+    return resp
@@ -158,7 +158,11 @@ class Controls(Groups):
     def __init__(self, ids, callbacks):
         super().__init__(ids, callbacks)
 
-    def group(self, title, display=None):
+    def group(self, title, display=None, cache=False):
+        """Adds a group of controls, shown only when `display`, a function
+        of control values, returns True. With `cache`, its results are
+        cached by control values (see Maproom's callback_cache).
+        """
         id = str(uuid.uuid4())
         if display is not None:
             if not callable(display):
@@ -167,7 +171,7 @@ class Controls(Groups):
             for p in signature(display).parameters.keys():
                 self._ids.validate(p, Control.KIND)
 
-            self._callbacks.add(display, id, "hidden")
+            self._callbacks.add(display, id, "hidden", cache=cache)
         super().group(title, id)
 
     def month(self, id, default='January'):
@@ -209,7 +213,13 @@ class Plots(Groups):
         p = Select(id, ["A", "B"], None)
         self._add_element("")
 
-    def output(self, title, function):
+    def output(self, title, function, data=None, cache=False):
+        """Adds a panel showing `function` of control values and marker
+        positions. With `cache`, its results are cached by input values
+        (see Maproom's callback_cache); if it reads the dataset at `data`,
+        marker positions are snapped to the dataset's grid cells first,
+        and results are recomputed when the dataset changes.
+        """
         # id = gensym()
         id = str(uuid.uuid4())
         if not callable(function):
@@ -219,7 +229,7 @@ class Plots(Groups):
             self._ids.validate(p, {"marker", Control.KIND})
 
         self._add_element(Output(id, title))
-        self._callbacks.add(function, id, "children")
+        self._callbacks.add(function, id, "children", data, cache)
 
     def render(self):
         return dbc.Tabs([
@@ -1,3 +1,4 @@
+import os
 import flask
 import dash
 from dash import html
@@ -8,16 +9,39 @@ from pathlib import Path
 from inspect import signature, Parameter
 from collections import OrderedDict
 
-from common import MaproomException, IDRegistry, CallbackRegistry, gensym, inverter, tile_url, tile_wrap
+from common import MaproomException, IDRegistry, CallbackRegistry, CallbackCache, TileCache, DATASETS, coalesced, colormap_lut, gensym, inverter, tile_url, tile_wrap
 import controls
+import asgi
+import points
+import pyramid
+import vector
 from controls import Controls, Plots
 import uuid
+import pingrid
 
 class Maproom:
-    def __init__(self, title, prefix, auto=False):
+    def __init__(self, title, prefix, auto=False, tile_cache=None, tile_encoding=None,
+                 result_cache_bytes=512 * 2**20, scheduler=None,
+                 callback_cache=None, point_cache_bytes=256 * 2**20):
         self.title = title
         self.prefix = prefix
         self.auto = auto
+        # dask scheduler for layers with chunks, see common.dask_scheduler
+        self.scheduler = scheduler
+        self.tile_cache = TileCache() if tile_cache is None else tile_cache
+        self.tile_encoding = (
+            pingrid.TileEncoding() if tile_encoding is None else tile_encoding
+        )
+        # results of layer functions registered with memoize=True
+        self.result_cache = pingrid.LRUCache(
+            result_cache_bytes, sizeof=lambda memo: memo[0].nbytes
+        )
+        # results of callbacks registered with cache=True
+        self.callback_cache = (
+            CallbackCache() if callback_cache is None else callback_cache
+        )
+        # series extracted by point_series
+        self.points = points.PointExtractor(point_cache_bytes)
 
         # private
         self._ids = IDRegistry()
@@ -28,12 +52,38 @@ class Maproom:
         self.plots = Plots(self._ids, self._callbacks)
         self._markers = []
         self._layers = []
+        self._overlays = []
+        # tile views of the layers, made by render
+        self._tile_views = []
 
     def marker(self, id, position):
         self._ids.add(id, "marker")
         self._markers.append([id, position])
 
-    def layer(self, label, function, data):
+    def layer(self, label, function, data, memoize=False, chunks=None, pyramids=None,
+              clipping=None, metatile=1):
+        """Adds a map layer drawn from `function(data, *params)`.
+
+        With `memoize`, `function` is evaluated once over the whole dataset
+        for each distinct set of control values, and tiles are cut from
+        the result. Use it for layers whose function is expensive compared
+        to the size of its result, e.g. reductions along time.
+
+        With `chunks` ("tiles" for chunks aligned with tiles, or a dict
+        of chunk sizes), `data` is opened with dask and `function` is
+        evaluated lazily, so datasets larger than memory can be served.
+
+        `pyramids` is a directory of precomputed overviews of the layer
+        (see `build_pyramid`); tiles for control values that have one are
+        read from it instead of evaluating `function`.
+
+        `clipping` is a shape (or a `pingrid.ShapeClipper`) outside of
+        which the layer is hidden, e.g. a country's border.
+
+        With `metatile` N > 1, tiles are rendered by blocks of N by N,
+        evaluating `function` once per block (see `common.tile_wrap`).
+        `function` must not depend on the extent of `data`.
+        """
         if not callable(function):
             raise MaproomException("Did not pass a function")
 
@@ -45,14 +95,74 @@ class Maproom:
         for p in params:
             self._ids.validate(p, {"marker", controls.Control.KIND})
 
+        # Opens the dataset and builds its grid descriptor now rather
+        # than on the first tile request.
+        if DATASETS.get(data, chunks)['grid'] is None:
+            raise MaproomException(f"`{data}` has no X and Y coordinates")
+
         self._layers.append({
             'label': label,
             'id': str(uuid.uuid4()),
             'function': function,
             'params': params,
             'data': data,
+            'memoize': memoize,
+            'chunks': chunks,
+            'pyramids': pyramids,
+            'clipping': (
+                clipping
+                if clipping is None or isinstance(clipping, pingrid.ShapeClipper)
+                else pingrid.ShapeClipper(clipping)
+            ),
+            'metatile': metatile,
+        })
+
+    def overlay(self, label, shapes, style=None):
+        """Adds an overlay of shapes, e.g. administrative boundaries, that
+        the browser draws over the map from GeoJSON simplified for the
+        zoom level, or from tiles of their outlines when zoomed in (see
+        `vector`). `shapes` is a shapely geometry, a list of them, or a
+        dict of them by name. `style` is the Leaflet path style of the
+        shapes (default is thin black lines); filled shapes are always
+        loaded whole, since tiles only have outlines.
+        """
+        self._overlays.append({
+            'label': label,
+            'id': str(uuid.uuid4()),
+            'vector': vector.VectorLayer(shapes),
+            'style': (
+                dict(color="black", weight=1, fill=False) if style is None else style
+            ),
         })
 
+    def _layer(self, label):
+        for l in self._layers:
+            if l['label'] == label:
+                return l
+        raise MaproomException(f"there is no layer `{label}`")
+
+    def build_pyramid(self, label, params, directory=None):
+        """Precomputes the pyramid of the layer labeled `label` for the
+        control values `params` (a dict keyed by parameter name), into
+        `directory` (default is the layer's `pyramids` directory).
+        Returns the path of the pyramid.
+        """
+        l = self._layer(label)
+        directory = l['pyramids'] if directory is None else directory
+        if directory is None:
+            raise MaproomException(f"layer `{label}` has no pyramids directory")
+        return pyramid.build(
+            l['data'], l['function'], params, directory, l['chunks'], self.scheduler
+        )
+
+    def point_series(self, data, position, variable=None):
+        """Returns the series of the dataset at `data` (its variable
+        `variable` if given) in the grid cell under the marker
+        `position`, for use in output functions. Series are cached, see
+        `points.PointExtractor`.
+        """
+        return self.points.series(data, position, variable)
+
 
     # render/start
     def render(self, server):
@@ -97,6 +207,19 @@ class Maproom:
                                 checked=False,
                             )
                             for l in self._layers
+                        ] + [
+                            dlf.Overlay(
+                                dlf.LayerGroup(
+                                    [dlf.GeoJSON(
+                                        url=f"/vector-{i}/0",
+                                        options=dict(style=o['style']),
+                                    )],
+                                    id=o['id'],
+                                ),
+                                name=o['label'],
+                                checked=True,
+                            )
+                            for i, o in enumerate(self._overlays)
                         ]),
                         dlf.LayerGroup([
                             dlf.Marker(id=m[0], position=m[1], draggable=True)
@@ -111,13 +234,23 @@ class Maproom:
             ])
         ], style={ 'height': '100vh' }, fluid=True)
         for c in self._callbacks.defs:
+            params = signature(c['function']).parameters.keys()
+            function = c['function'] if c['prop'] != "hidden" else inverter(c['function'])
+            if c['cache']:
+                function = self.callback_cache.wrap(
+                    function, c['output'],
+                    [p for p in params if self._ids.kind(p) == "marker"],
+                    c['data'],
+                )
+            else:
+                function = coalesced(function)
             APP.callback(
                 output=Output(c['output'], c["prop"]),
                 inputs={
                     p: Input(p, "position" if self._ids.kind(p) == "marker" else "value")
-                    for p in signature(c['function']).parameters.keys()
+                    for p in params
                 }
-            )(c['function'] if c['prop'] != "hidden" else inverter(c['function']))
+            )(function)
 
         # if len(self._markers) > 1:
         #     APP.callback(
@@ -125,6 +258,7 @@ class Maproom:
         #         Input("__map", "click_lat_lng"),
         #     )(lambda x: self._markers[0][1] if x is None else x)
 
+        self._tile_views = [self._tile_view(l) for l in self._layers]
         for i, l in enumerate(self._layers):
             APP.callback(
                 output=Output(l['id'], 'url'),
@@ -134,11 +268,47 @@ class Maproom:
                 }
             )(tile_url(f"tile-{i}"))
 
-            server.route(f"/tile-{i}/<int:tz>/<int:tx>/<int:ty>")(
-                tile_wrap(l['data'], l['function'])
+            tile = self._tile_views[i]
+            server.route(f"/tile-{i}/<int:tz>/<int:tx>/<int:ty>", endpoint=f"tile-{i}")(
+                tile
+            )
+            # values for client-side colormapping, see common.tile_wrap
+            server.route(
+                f"/value-{i}/<int:tz>/<int:tx>/<int:ty>.<format>", endpoint=f"value-{i}"
+            )(tile.value)
+
+        for i, o in enumerate(self._overlays):
+            APP.callback(
+                output=Output(o['id'], 'children'),
+                inputs=[Input("__map", "zoom"), Input("__map", "bounds")],
+            )(
+                lambda zoom, bounds, i=i, style=o['style']: [
+                    dlf.GeoJSON(url=url, options=dict(style=style))
+                    for url in vector.urls(
+                        f"/vector-{i}", zoom, bounds, tiled=not style.get("fill")
+                    )
+                ]
+            )
+
+            tile, zoom = vector.vector_wrap(
+                o['vector'], self.tile_cache, f"{self.prefix}/{o['label']}"
             )
+            server.route(
+                f"/vector-{i}/<int:tz>/<int:tx>/<int:ty>", endpoint=f"vector-{i}"
+            )(tile)
+            server.route(f"/vector-{i}/<int:tz>", endpoint=f"vector-{i}-zoom")(zoom)
+        server.route("/colormaps/<name>", endpoint="colormaps")(colormap_lut)
         return APP
 
+    def _tile_view(self, l):
+        return tile_wrap(l['data'], l['function'], self.tile_cache,
+                         f"{self.prefix}/{l['label']}", self.tile_encoding,
+                         self.result_cache if l['memoize'] else None,
+                         l['chunks'], self.scheduler,
+                         None if l['pyramids'] is None
+                         else pyramid.overviews(l['pyramids'], l['params']),
+                         l['clipping'], l['metatile'])
+
 
     def start(self):
         SERVER = flask.Flask(__name__)
@@ -146,3 +316,78 @@ class Maproom:
         APP.run_server(
             threaded=False,
         )
+
+    def warm(self):
+        """Opens every layer's dataset and compiles the colormap LUTs, so
+        that the first requests don't pay for it.
+        """
+        for l in self._layers:
+            DATASETS.get(l['data'], l['chunks'])
+        for cs in pingrid.CMAPS.values():
+            cs.to_bgra_array(lutsize=256)
+
+    def serve(self, host="127.0.0.1", port=8050, workers=None, threads=8,
+              timeout=120):
+        """Serves the maproom for production with a pre-fork gunicorn server
+        of `workers` processes (default is one per CPU), each handling up to
+        `threads` requests concurrently. Every worker is warmed up before it
+        accepts traffic. Requires gunicorn, an optional dependency (the `serve`
+        extra).
+        """
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError as e:
+            raise MaproomException(
+                "serve() requires gunicorn, which is optional: install it with "
+                "`conda install -c conda-forge gunicorn` or `pip install akhali[serve]`"
+            ) from e
+
+        SERVER = flask.Flask(__name__)
+        self.render(SERVER)
+        maproom = self
+
+        def post_fork(arbiter, worker):
+            # File handles opened before the fork must not be shared
+            # between workers.
+            DATASETS.clear()
+            maproom.warm()
+
+        class Application(BaseApplication):
+            def load_config(self):
+                self.cfg.set("bind", f"{host}:{port}")
+                self.cfg.set("workers", workers or os.cpu_count() or 1)
+                self.cfg.set("threads", threads)
+                self.cfg.set("worker_class", "gthread")
+                self.cfg.set("timeout", timeout)
+                self.cfg.set("post_fork", post_fork)
+
+            def load(self):
+                return SERVER
+
+        Application().run()
+
+    def asgi(self, workers=None, queue=64, retry_after=1):
+        """Makes an ASGI application serving the maproom, to run with e.g.
+        uvicorn. Tile requests are served asynchronously: cache lookups
+        run off the event loop, and tiles are rendered by a pool of
+        `workers` threads (default is one per CPU) with at most `queue`
+        renders waiting, beyond which requests are turned away with 503.
+        The Dash app is served through asgiref's WSGI adapter (requires
+        asgiref, an optional dependency: the `asgi` extra).
+        """
+        try:
+            from asgiref.wsgi import WsgiToAsgi
+        except ImportError as e:
+            raise MaproomException(
+                "asgi() requires asgiref, which is optional: install it with "
+                "`conda install -c conda-forge asgiref` or `pip install akhali[asgi]`"
+            ) from e
+
+        SERVER = flask.Flask(__name__)
+        self.render(SERVER)
+        self.warm()
+        # the views the Flask routes use, sharing their caches and
+        # in-flight renders
+        return asgi.TileApp(
+            self._tile_views, WsgiToAsgi(SERVER), workers, queue, retry_after,
+        )
@@ -3,12 +3,22 @@ __all__ = [
     'ClientSideError',
     'Color',
     'ColorScale',
+    'Grid',
     'InvalidRequestError',
+    'LRUCache',
+    'MERCATOR_LAT_LIMIT',
     'NotFoundError',
+    'ShapeClipper',
+    'ShapeMask',
+    'TileEncoding',
+    'VALUE_FORMATS',
     'average_over',
     'client_side_error',
+    'composite_masks',
     'deep_merge',
     'empty_tile',
+    'empty_tile_bytes',
+    'encode_image',
     'error_fig',
     'image_resp',
     'load_config',
@@ -17,14 +27,28 @@ __all__ = [
     'parse_arg',
     'parse_colormap',
     'sel_snap',
+    'shape_mask',
     'tile',
+    'tile_bytes',
+    'tile_chunks',
+    'tile_column',
+    'tile_lat_centers',
     'tile_left',
+    'tile_lon_centers',
+    'tile_row_mercator',
     'tile_top_mercator',
     'to_dash_colorscale',
+    'value_tile_bytes',
+    'zonal_stats',
 ]
 
 import copy
-import io
+import functools
+import hashlib
+import struct
+import threading
+import zlib
+from collections import OrderedDict
 from typing import Tuple, List, Literal, Optional, Union, Callable, Iterable as Iterable
 from typing import NamedTuple
 import math
@@ -38,7 +62,10 @@ import psycopg2.extensions
 from psycopg2 import sql
 import rasterio.features
 import rasterio.transform
+import scipy.sparse
+import shapely
 import shapely.geometry
+import shapely.wkb
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipoint import MultiPoint
@@ -104,20 +131,65 @@ class ColorScale:
     See Also
     --------
     Colors
+
+    Notes
+    -----
+    Instances are immutable and hashable, which lets the lookup tables
+    built by `to_rgba_array` and `to_bgra_array` be memoized per `lutsize`.
     """
 
+    __slots__ = ("name", "colors", "scale", "_hash")
+
     def __init__(self, name, colors, scale=None):
-        self.name = name
-        self.colors = np.array(colors)
+        colors = np.array(colors)
+        colors.setflags(write=False)
         if scale is None:
-            self.scale = list(np.arange(len(colors)))
+            scale = np.arange(len(colors))
         else:
            if (np.diff(scale) < 0).any():
               raise Exception("scale must be monotically increasing")
-           elif len(colors) == len(scale):
-               self.scale = scale
-           else:
+           elif len(colors) != len(scale):
                raise Exception("scale must be same length as colors")
+        scale = tuple(np.asarray(scale, np.float64).tolist())
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "colors", colors)
+        object.__setattr__(self, "scale", scale)
+        object.__setattr__(
+            self, "_hash", hash((name, colors.shape, colors.tobytes(), scale))
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ColorScale is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ColorScale is immutable")
+
+    # Copying and pickling would restore the slots through __setattr__;
+    # being immutable, a ColorScale is its own copy, and is pickled as
+    # the arguments that rebuild it.
+    def __reduce__(self):
+        return (ColorScale, (self.name, self.colors, list(self.scale)))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ColorScale)
+            and self._hash == other._hash
+            and self.name == other.name
+            and self.scale == other.scale
+            and np.array_equal(self.colors, other.colors)
+        )
+
+    def __repr__(self):
+        return f"ColorScale({self.name!r}, {self.colors.tolist()!r}, {list(self.scale)!r})"
 
     def reversed(self, name=None):
         """Reverts the order of the `colors` of a ColorScale instance.
@@ -170,50 +242,13 @@ class ColorScale:
         -------
         2d-array[int]
             `lutsize` RGBA quantizations linearly interpolated between anchors.
+            The array is memoized and read-only.
 
         See Also
         --------
         to_bgra_array
         """
-        cs = self.rescaled(0, lutsize-1)
-        n_anchors =  len(cs.scale)
-        # append output is not used but saves writing a condition dedicated to last color
-        delta_colors  = np.diff(cs.colors, axis=0, append=np.expand_dims(cs.colors[-1,:], 0))
-        delta_scale = np.diff(cs.scale, append=cs.scale[-1])
-        # Construct lutsize x 4 Color array
-        rgbaa = np.transpose(
-            np.array(
-                [
-                    np.piecewise(
-                        # Rescale lut indices to colors piece by piece
-                        np.arange(lutsize),
-                        # Rescale differently from one anchor point to the next
-                        [(np.arange(lutsize) >= cs.scale[i])
-                            & (np.arange(lutsize)  < cs.scale[i+1])
-                                for i in range(n_anchors-1)]
-                        + [np.arange(lutsize) == cs.scale[-1]],
-                        # Rescaling is linear from one anchor to the next
-                        [np.polynomial.polynomial.Polynomial(
-                            # Unless it's a discontinuity then there is no rescaling
-                            [cs.colors[i, band], 0] if delta_scale[i] == 0
-                                # Intercept and slope of the linear relation
-                                else [
-                                    cs.colors[i, band] - cs.scale[i]
-                                        * delta_colors[i, band] / delta_scale[i],
-                                    delta_colors[i, band] / delta_scale[i],
-                                ]
-                        ) for i in range(n_anchors)]
-                        # This is the lambda version of the Polynomial
-                        # just can't get it to work... Leaving it here for someone smarter than me
-                        ##[lambda x: (cs.colors[i, band]
-                        ##    + 0 if np.diff(cs.scale, append=cs.scale[-1])[i] == 0 else ((x - cs.scale[i]) * delta_colors[i, band] / delta_scale[i])
-                        ##) for i in range(n_anchors)]
-                    # Same rescaling to all color bands
-                    ) for band in range(4)
-                ]
-            )
-        ).astype(int)
-        return rgbaa
+        return _rgba_lut(self, lutsize)
 
     def to_bgra_array(self, lutsize=256):
         """A `lutsize` -by-BGRA array representation of a ColorScale instance.
@@ -227,12 +262,13 @@ class ColorScale:
         -------
         2d-array[int]
             `lutsize` BGRA quantizations linearly interpolated between anchors.
+            The array is memoized and read-only.
 
         See Also
         --------
         to_rgba_array
         """
-        return self.to_rgba_array(lutsize=lutsize)[:,[2, 1, 0, 3]]
+        return _bgra_lut(self, lutsize)
 
     def to_dash_leaflet(self, lutsize=256):
         """A hexadecimal `lutsize` array representation of a ColorScale instance.
@@ -254,6 +290,44 @@ class ColorScale:
         return [Color(*x).to_hex_rgba() for x in self.to_rgba_array(lutsize=lutsize)]
 
 
+@functools.lru_cache(maxsize=256)
+def _rgba_lut(cs: ColorScale, lutsize: int) -> np.ndarray:
+    cs = cs.rescaled(0, lutsize-1)
+    x = np.arange(lutsize)
+    scale = np.array(cs.scale)
+    n_anchors = len(scale)
+    # append output is not used but saves writing a condition dedicated to last color
+    delta_colors = np.diff(cs.colors, axis=0, append=np.expand_dims(cs.colors[-1,:], 0))
+    delta_scale = np.diff(scale, append=scale[-1])
+    # Rescaling is linear from one anchor to the next, unless it's a
+    # discontinuity, then there is no rescaling. Intercept and slope are
+    # computed in the same order as they used to be for each anchor, so
+    # that the truncation to int below lands on the same values.
+    flat = (delta_scale == 0)[:, None]
+    safe_delta_scale = np.where(delta_scale == 0, 1, delta_scale)[:, None]
+    slope = np.where(flat, 0, delta_colors / safe_delta_scale)
+    intercept = np.where(
+        flat, cs.colors, cs.colors - scale[:, None] * delta_colors / safe_delta_scale
+    )
+    # Each lut index falls in the piece starting at the last anchor at or
+    # below it; only the last anchor itself belongs to the last piece.
+    piece = np.searchsorted(scale, x, side="right") - 1
+    covered = (piece >= 0) & ((piece < n_anchors - 1) | (x == scale[-1]))
+    piece = np.clip(piece, 0, n_anchors - 1)
+    rgbaa = np.where(
+        covered[:, None], intercept[piece] + slope[piece] * x[:, None], 0
+    ).astype(int)
+    rgbaa.setflags(write=False)
+    return rgbaa
+
+
+@functools.lru_cache(maxsize=256)
+def _bgra_lut(cs: ColorScale, lutsize: int) -> np.ndarray:
+    bgra = _rgba_lut(cs, lutsize)[:,[2, 1, 0, 3]]
+    bgra.setflags(write=False)
+    return bgra
+
+
 class Color(NamedTuple):
     """A sub-class of NamedTuple to define RGBA colors.
 
@@ -309,6 +383,110 @@ class Color(NamedTuple):
         return f"#{self.blue:02x}{self.green:02x}{self.red:02x}{self.alpha:02x}"
 
 
+class Grid(NamedTuple):
+    """Descriptor of a regularly spaced X/Y grid.
+
+    Lets callers locate coordinates and bounding boxes in index space
+    without scanning or label-searching the coordinate arrays.
+
+    Parameters
+    ----------
+    x0, y0 : float
+        coordinate of the first cell center
+    dx, dy : float
+        signed step between cell centers, negative when the
+        coordinate decreases with the index
+    nx, ny : int
+        number of cells
+    regular : bool
+        whether the coordinates are evenly spaced. When False, the steps
+        and the index methods are meaningless; only `bounds` and
+        `intersects` are, given `extent`.
+    extent : tuple of float, optional
+        (x_min, y_min, x_max, y_max) of the cell centers, as returned by
+        `bounds`; needed for uneven coordinates, whose extent is not
+        implied by the first step (default is to derive it from it)
+    """
+    x0: float
+    dx: float
+    nx: int
+    y0: float
+    dy: float
+    ny: int
+    regular: bool
+    extent: Optional[Tuple[float, float, float, float]] = None
+
+    @classmethod
+    def from_coords(cls, x: np.ndarray, y: np.ndarray) -> "Grid":
+        x = np.asarray(x, np.float64)
+        y = np.asarray(y, np.float64)
+        regular = len(x) >= 2 and len(y) >= 2
+        if regular:
+            dx = x[1] - x[0]
+            dy = y[1] - y[0]
+            regular = (
+                dx != 0 and dy != 0
+                and np.allclose(np.diff(x), dx, rtol=0, atol=abs(dx) * 1e-3)
+                and np.allclose(np.diff(y), dy, rtol=0, atol=abs(dy) * 1e-3)
+            )
+        else:
+            dx = dy = np.nan
+        return cls(
+            float(x[0]), float(dx), len(x), float(y[0]), float(dy), len(y),
+            bool(regular),
+            (float(x.min()), float(y.min()), float(x.max()), float(y.max())),
+        )
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """Returns (x_min, y_min, x_max, y_max) of the cell centers."""
+        if self.extent is not None:
+            return self.extent
+        x1 = self.x0 + (self.nx - 1) * self.dx
+        y1 = self.y0 + (self.ny - 1) * self.dy
+        return min(self.x0, x1), min(self.y0, y1), max(self.x0, x1), max(self.y0, y1)
+
+    def intersects(self, x_min, y_min, x_max, y_max) -> bool:
+        gx_min, gy_min, gx_max, gy_max = self.bounds()
+        return not (
+            x_min > gx_max or x_max < gx_min or y_min > gy_max or y_max < gy_min
+        )
+
+    def _index_range(self, v0, step, n, v_min, v_max, margin) -> slice:
+        f0 = (v_min - v0) / step
+        f1 = (v_max - v0) / step
+        # cell i spans fractional indices [i - 0.5, i + 0.5)
+        start = max(math.floor(min(f0, f1) + 0.5) - margin, 0)
+        stop = min(math.floor(max(f0, f1) + 0.5) + margin + 1, n)
+        if stop - start < 2:
+            # interpolation needs at least two points along each dimension
+            start = max(min(start, n - 2), 0)
+            stop = min(start + 2, n)
+        return slice(start, stop)
+
+    def cell(self, x: float, y: float) -> Optional[Tuple[int, int]]:
+        """Returns the (X, Y) index of the cell whose center is nearest to
+        (x, y), or None if (x, y) is outside the cell centers' bounds,
+        as `sel_snap` does.
+        """
+        x_min, y_min, x_max, y_max = self.bounds()
+        if not (x_min <= x <= x_max and y_min <= y <= y_max):
+            return None
+        ix = min(max(math.floor((x - self.x0) / self.dx + 0.5), 0), self.nx - 1)
+        iy = min(max(math.floor((y - self.y0) / self.dy + 0.5), 0), self.ny - 1)
+        return ix, iy
+
+    def index_ranges(
+        self, x_min, y_min, x_max, y_max, margin: int = 1
+    ) -> Tuple[slice, slice]:
+        """Returns the X and Y index slices of the cells overlapping a
+        bounding box, padded by `margin` cells on each side.
+        """
+        return (
+            self._index_range(self.x0, self.dx, self.nx, x_min, x_max, margin),
+            self._index_range(self.y0, self.dy, self.ny, y_min, y_max, margin),
+        )
+
+
 class DrawAttrs(NamedTuple):
     line_color: Union[int, Color]
     background_color: Union[int, Color]
@@ -332,20 +510,72 @@ def deg_to_mercator(lats: float) -> float:
     return np.rad2deg(rad_to_mercator(np.deg2rad(lats)))
 
 
+def _nearest_index(
+    x0: float, dx: float, n: int, x: np.ndarray
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Source indices of the cells nearest to `x` along an axis of `n`
+    cells starting at `x0` every `dx`, and a mask of the `x` that fall
+    inside the axis (None when they all do).
+    """
+    # Same arithmetic as indexing into the axis padded by one cell on
+    # each side, so that cell boundaries round the same way.
+    p = np.floor((x - (x0 - 1.5 * dx)) / dx)
+    valid = (p >= 1) & (p <= n)
+    index = np.clip(p - 1, 0, n - 1).astype(np.intp)
+    return index, (None if valid.all() else valid)
+
+
+def _linear_index(
+    x0: float, dx: float, n: int, x: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """Lower source indices and weights of the upper neighbor for linear
+    interpolation at `x`, and the mask of `x` inside the axis. Points in
+    the outer half of the edge cells take the edge value.
+    """
+    assert n >= 2
+    f = (x - x0) / dx
+    valid = (f >= -0.5) & (f < n - 0.5)
+    index = np.clip(np.floor(f), 0, n - 2).astype(np.intp)
+    weight = np.clip(f - index, 0.0, 1.0)
+    return index, weight, (None if valid.all() else valid)
+
+
+def _mask_invalid(out: np.ndarray, valids: Iterable[Optional[np.ndarray]]):
+    for axis, valid in enumerate(valids):
+        if valid is not None:
+            out[(slice(None),) * axis + (~valid,)] = np.nan
+    return out
+
+
+def _gather(
+    data: np.ndarray,
+    indexes: Iterable[np.ndarray],
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Outer-indexes `data` with one index vector per axis."""
+    indexes = list(indexes)
+    for axis, index in enumerate(indexes[:-1]):
+        data = np.take(data, index, axis=axis, mode="clip")
+    return np.take(data, indexes[-1], axis=len(indexes) - 1, out=out, mode="clip")
+
+
+def _resampled_dtype(data: np.ndarray) -> np.dtype:
+    # results need to hold NaN outside of the input
+    return np.result_type(data.dtype, np.float32)
+
+
 def nearest_interpolator(
     input_grids: Iterable[Tuple[float, float]],  # [(y0, dy), (x0, dx), ...]
     input_data: np.ndarray,
 ) -> FuncInterp2d:
-    padded_data = np.pad(
-        input_data, pad_width=1, mode="constant", constant_values=np.nan
-    )
+    input_data = input_data.astype(_resampled_dtype(input_data), copy=False)
 
     def interp_func(output_grids: Iterable[np.ndarray]) -> np.ndarray:
-        index = tuple(
-            np.minimum(np.maximum(((x - (x0 - 1.5 * dx)) / dx).astype(int), 0), n - 1)
-            for (x0, dx), x, n in zip(input_grids, output_grids, padded_data.shape)
-        )
-        return padded_data[tuple(reversed(np.meshgrid(*reversed(index))))]
+        index, valid = zip(*(
+            _nearest_index(x0, dx, n, np.asarray(x))
+            for (x0, dx), x, n in zip(input_grids, output_grids, input_data.shape)
+        ))
+        return _mask_invalid(_gather(input_data, index), valid)
 
     return interp_func
 
@@ -362,6 +592,84 @@ def create_interp(da: xr.DataArray) -> FuncInterp2d:
     return f
 
 
+@functools.lru_cache(maxsize=8192)
+def _tile_index(v0, dv, n, axis, t, tz, size, method):
+    """Resampling indices from an axis of a grid to the pixels of row or
+    column `t` of the tile grid. Memoized per (axis grid, tz, t), since
+    every tile of a row or column of a layer shares them.
+    """
+    if axis == "lon":
+        centers = tile_lon_centers(t, tz, size)
+    else:
+        centers = tile_lat_centers(t, tz, size)
+    if method == "nearest":
+        result = _nearest_index(v0, dv, n, centers)
+    elif method == "bilinear":
+        result = _linear_index(v0, dv, n, centers)
+    else:
+        raise ValueError(f"unknown interpolation method `{method}`")
+    for a in result:
+        if a is not None:
+            a.setflags(write=False)
+    return result
+
+
+def resample_tile(
+    data: np.ndarray,
+    grid: "Grid",
+    tx: int,
+    ty: int,
+    tz: int,
+    tile_width: int = 256,
+    tile_height: int = 256,
+    method: Literal["nearest", "bilinear"] = "nearest",
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Resamples a lat-by-lon array on a regular `grid` to the pixels of a
+    tile, NaN outside of the grid.
+
+    Parameters
+    ----------
+    data : 2d-array
+        values, lat along the first axis and lon along the second
+    grid : Grid
+        descriptor of `data`'s lon (X) and lat (Y) coordinates
+    tx, ty, tz : int
+        tile column, row and scale
+    method : {"nearest", "bilinear"}, optional
+        interpolation method (default is nearest neighbor)
+    out : 2d-array, optional
+        `tile_height` -by- `tile_width` buffer to write the result into
+
+    Returns
+    -------
+    2d-array[float]
+        `tile_height` -by- `tile_width` resampled values
+    """
+    dtype = _resampled_dtype(data)
+    data = data.astype(dtype, copy=False)
+    if out is None:
+        out = np.empty((tile_height, tile_width), dtype)
+    y_index = _tile_index(
+        grid.y0, grid.dy, grid.ny, "lat", ty, tz, tile_height, method
+    )
+    x_index = _tile_index(
+        grid.x0, grid.dx, grid.nx, "lon", tx, tz, tile_width, method
+    )
+    if method == "nearest":
+        (yi, y_valid), (xi, x_valid) = y_index, x_index
+        _gather(data, (yi, xi), out=out)
+    else:
+        (yi, yw, y_valid), (xi, xw, x_valid) = y_index, x_index
+        rows = (
+            np.take(data, yi, axis=0) * (1.0 - yw)[:, None]
+            + np.take(data, yi + 1, axis=0) * yw[:, None]
+        )
+        np.multiply(np.take(rows, xi, axis=1), 1.0 - xw, out=out)
+        out += np.take(rows, xi + 1, axis=1) * xw
+    return _mask_invalid(out, (y_valid, x_valid))
+
+
 def from_months_since(x, year_since=1960):
     int_x = int(x)
     return datetime.date(
@@ -404,6 +712,24 @@ def tile_top_mercator(ty: int, tz: int) -> float:
     return np.rad2deg(mercator_to_rad(a))
 
 
+def tile_column(lon: float, tz: int) -> int:
+    """Inverse of `tile_left`: the column number of the tile at scale z
+    that contains longitude `lon`, clamped to the tile grid.
+    """
+    return min(max(math.floor((lon + 180) / 360 * 2 ** tz), 0), 2 ** tz - 1)
+
+
+def tile_row_mercator(lat: float, tz: int) -> int:
+    """Inverse of `tile_top_mercator`: the row number of the tile at
+    scale z of the spherical Mercator tile grid that contains latitude
+    `lat`, clamped to the tile grid.
+    """
+    # the poles project to infinity
+    lat = min(max(lat, -MERCATOR_LAT_LIMIT), MERCATOR_LAT_LIMIT)
+    y = rad_to_mercator(np.deg2rad(lat))
+    return min(max(math.floor((math.pi - y) / (2 * math.pi) * 2 ** tz), 0), 2 ** tz - 1)
+
+
 def pixel_extents(g: Callable[[int, int], float], tx: int, tz: int, n: int = 1):
     """Given a function that maps a tile coordinate (row or column number)
     to the start of that tile (top or left edge) in degrees, returns
@@ -418,22 +744,154 @@ def pixel_extents(g: Callable[[int, int], float], tx: int, tz: int, n: int = 1):
         a = b
 
 
-def tile(da, tx, ty, tz, clipping=None):
+def pixel_centers(
+    g: Callable[[np.ndarray, int], np.ndarray],
+    t: Union[int, np.ndarray],
+    tz: int,
+    n: int = 1,
+) -> np.ndarray:
+    """Vectorized counterpart of `pixel_extents`: returns the center of
+    each of the `n` pixels of tile `t` along one dimension, as the
+    midpoint of the pixel's edges in degrees. `g` must accept arrays.
+    If `t` is an array of tile numbers, the result has one row per tile.
+    """
+    t = np.asarray(t)
+    assert n >= 1 and tz >= 0 and ((0 <= t) & (t < 2 ** tz)).all()
+    edges = g(np.add.outer(t.astype(np.double), np.arange(n + 1) / n), tz)
+    a = edges[..., :-1]
+    b = edges[..., 1:]
+    return a + (b - a) / 2.0
+
+
+@functools.lru_cache(maxsize=4096)
+def tile_lon_centers(tx: int, tz: int, n: int = 256) -> np.ndarray:
+    """Longitudes of the pixel centers of column `tx` at scale `tz`.
+    Memoized, since every tile in a column shares them; the returned
+    array is read-only.
+    """
+    x = pixel_centers(tile_left, tx, tz, n)
+    x.setflags(write=False)
+    return x
+
+
+@functools.lru_cache(maxsize=4096)
+def tile_lat_centers(ty: int, tz: int, n: int = 256) -> np.ndarray:
+    """Latitudes of the pixel centers of row `ty` at scale `tz` in the
+    spherical Mercator tile grid. Memoized, since every tile in a row
+    shares them; the returned array is read-only.
+    """
+    y = pixel_centers(tile_top_mercator, ty, tz, n)
+    y.setflags(write=False)
+    return y
+
+
+def tile(da, tx, ty, tz, clipping=None, encoding=None):
+    if encoding is None:
+        encoding = PNG
+    return flask.Response(
+        tile_bytes(da, tx, ty, tz, clipping, encoding), mimetype=encoding.mimetype
+    )
+
+
+def tile_bytes(da, tx, ty, tz, clipping=None, encoding=None) -> bytes:
+    """Like `tile`, but returns the encoded image instead of a response."""
     image_array = _tile(da, tx, ty, tz, clipping)
-    return image_resp(image_array)
+    if image_array is None:
+        return empty_tile_bytes(encoding)
+    return encode_image(image_array, encoding)
+
+
+VALUE_FORMATS = {
+    "png": "image/png",
+    "f32": "application/octet-stream",
+}
+
+
+def value_tile_bytes(
+    da, tx, ty, tz, format="png", clipping=None
+) -> Tuple[bytes, dict]:
+    """Encodes the values of a tile rather than their colors, for
+    clients that apply the colormap themselves.
+
+    Parameters
+    ----------
+    da : DataArray or None
+        the data, with lon/lat coordinates and the `colormap`,
+        `scale_min` and `scale_max` attributes of layer results; None
+        for a tile with no data
+    tx, ty, tz : int
+        the tile
+    format : {"png", "f32"}, optional
+        "png" is a 16-bit grayscale PNG of values quantized linearly
+        between the tile's minimum and maximum, with 0 for missing
+        values: value = offset + (code - 1) * scale. "f32" is the raw
+        little-endian float32 values, row by row from the top, NaN
+        where missing. (default is "png")
+    clipping : ShapeClipper, optional
+        pixels outside of its shape (more than half, for edge pixels)
+        are missing
+
+    Returns
+    -------
+    bytes, dict
+        the encoded tile, and its metadata as HTTP headers: the tile
+        size, the quantization of "png" tiles, and the colormap and
+        range the layer would be drawn with
+    """
+    if format not in VALUE_FORMATS:
+        raise InvalidRequestError(f"unknown value tile format `{format}`")
+    z = None if da is None else produce_data_tile(da, tx, ty, tz)
+    if z is None:
+        z = np.full((256, 256), np.nan, np.float32)
+    else:
+        z = z.astype(np.float32)
+    if isinstance(clipping, ShapeClipper):
+        mask = clipping.mask(tx, ty, tz, z.shape[1], z.shape[0])
+        if mask is not None:
+            z[mask >= 128] = np.nan
+
+    attrs = {} if da is None else da.attrs
+    cs = attrs.get("colormap")
+    headers = {
+        "X-Tile-Size": f"{z.shape[1]},{z.shape[0]}",
+        "X-Colormap": cs.name if isinstance(cs, ColorScale) else "",
+        "X-Scale-Min": repr(float(attrs.get("scale_min", np.nan))),
+        "X-Scale-Max": repr(float(attrs.get("scale_max", np.nan))),
+    }
+    if format == "f32":
+        return z.astype("<f4").tobytes(), headers
+
+    valid = ~np.isnan(z)
+    offset = float(z[valid].min()) if valid.any() else 0.0
+    spread = float(z[valid].max()) - offset if valid.any() else 0.0
+    # codes 1 to 65535, 0 being the missing value
+    scale = spread / 65534 if spread > 0 else 1.0
+    codes = np.zeros(z.shape, np.uint16)
+    codes[valid] = np.rint((z[valid] - offset) / scale) + 1
+    cv2_imencode_success, buffer = cv2.imencode(".png", codes)
+    assert cv2_imencode_success
+    headers.update({
+        "X-Value-Scale": repr(scale),
+        "X-Value-Offset": repr(offset),
+        "X-Value-Nodata": "0",
+    })
+    return buffer.tobytes(), headers
 
 
 def _tile(da, tx, ty, tz, clipping):
+    """Returns the BGRA image of a tile, or None if the tile is blank."""
     z = produce_data_tile(da, tx, ty, tz)
     if z is None:
-        return empty_tile()
+        return None
     im = apply_colormap(
         z,
         da.attrs["colormap"].to_bgra_array(lutsize=256),
         da.attrs["scale_min"],
         da.attrs["scale_max"],
     )
-    if clipping is not None:
+    if isinstance(clipping, ShapeClipper):
+        im = clipping.clip(im, tx, ty, tz)
+    elif clipping is not None:
         if callable(clipping):
             clipping = clipping()
         draw_attrs = DrawAttrs(
@@ -450,14 +908,22 @@ def empty_tile(width: int = 256, height: int = 256):
     # of a function, but we're keeping open the option of changing
     # tile size. Also, numpy arrays are mutable, and having a mutable
     # global constant could lead to tricky bugs.
-    im = apply_colormap(
-        np.full([height, width], np.nan),
-        np.zeros((256, 4)),
-        # arbitrary min and max
-        scale_min=0,
-        scale_max=0,
-    )
-    return im
+    return np.zeros((height, width, 4), np.uint8)
+
+
+def empty_tile_bytes(
+    encoding: Optional["TileEncoding"] = None, width: int = 256, height: int = 256
+) -> bytes:
+    """The fully transparent tile, encoded once per size and encoding.
+    Unlike the array from `empty_tile`, bytes are immutable, so they are
+    safe to share.
+    """
+    return _empty_tile_bytes(PNG if encoding is None else encoding, width, height)
+
+
+@functools.lru_cache(maxsize=64)
+def _empty_tile_bytes(encoding: "TileEncoding", width: int, height: int) -> bytes:
+    return encoding.encode(empty_tile(width, height))
 
 
 def produce_data_tile(
@@ -467,33 +933,145 @@ def produce_data_tile(
     tz: int,
     tile_width: int = 256,
     tile_height: int = 256,
-) -> np.ndarray:
-    x = np.fromiter(
-        (a + (b - a) / 2.0 for a, b in pixel_extents(tile_left, tx, tz, tile_width)),
-        np.double,
-    )
-    y = np.fromiter(
-        (a + (b - a) / 2.0 for a, b in pixel_extents(tile_top_mercator, ty, tz, tile_height)),
-        np.double,
+    out: Optional[np.ndarray] = None,
+) -> Optional[np.ndarray]:
+    """Resamples `da` to the pixels of a tile, or returns None if the tile
+    doesn't overlap `da`. The interpolation method is taken from
+    `da.attrs["interpolation"]` ("nearest", the default, or "bilinear").
+    """
+    lon = da['lon'].values
+    lat = da['lat'].values
+    # require at least 2 points in each spatial dimension, and assuming that the grid is even
+    grid = Grid(
+        lon[0], lon[1] - lon[0], len(lon), lat[0], lat[1] - lat[0], len(lat), True
     )
-    tile_bbox = shapely.geometry.box(x[0], y[0], x[-1], y[-1])
-    lon = da['lon']
-    lat = da['lat']
-    da_bbox = shapely.geometry.box(lon[0], lat[0], lon[-1], lat[-1])
-    if tile_bbox.intersects(da_bbox):
-        interp = create_interp(da)
-        z = interp([y, x])
+    x = tile_lon_centers(tx, tz, tile_width)
+    y = tile_lat_centers(ty, tz, tile_height)
+    if grid.intersects(
+        min(x[0], x[-1]), min(y[0], y[-1]), max(x[0], x[-1]), max(y[0], y[-1])
+    ):
+        z = resample_tile(
+            da.transpose("lat", "lon").values, grid, tx, ty, tz,
+            tile_width, tile_height,
+            method=da.attrs.get("interpolation", "nearest"),
+            out=out,
+        )
     else:
         z = None
     return z
 
 
-def image_resp(im):
-    cv2_imencode_success, buffer = cv2.imencode(".png", im)
-    assert cv2_imencode_success
-    io_buf = io.BytesIO(buffer)
-    resp = flask.send_file(io_buf, mimetype="image/png")
-    return resp
+class TileEncoding(NamedTuple):
+    """How tile images are encoded.
+
+    Parameters
+    ----------
+    format : {"png", "png8", "webp"}, optional
+        "png" is 32-bit BGRA PNG. "png8" is 8-bit (or fewer) paletted PNG
+        with transparency, falling back to "png" for images of more than
+        256 colors; colormapped tiles never have more. "webp" is WebP
+        with alpha. (default is "png")
+    png_compression : int, optional
+        zlib compression level from 0 (none, fastest) to 9 (smallest)
+        (default is the encoder's own default)
+    webp_quality : int, optional
+        WebP quality from 1 to 100, or 101 for lossless (default is 101)
+    """
+    format: Literal["png", "png8", "webp"] = "png"
+    png_compression: Optional[int] = None
+    webp_quality: int = 101
+
+    @property
+    def mimetype(self) -> str:
+        return "image/webp" if self.format == "webp" else "image/png"
+
+    def encode(self, im: np.ndarray) -> bytes:
+        if self.format == "png8":
+            buf = encode_png8(im, self.png_compression)
+            if buf is not None:
+                return buf
+        if self.format in ("png", "png8"):
+            params = []
+            if self.png_compression is not None:
+                params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+            ext = ".png"
+        elif self.format == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality]
+            ext = ".webp"
+        else:
+            raise ValueError(f"unknown tile format `{self.format}`")
+        cv2_imencode_success, buffer = cv2.imencode(ext, im, params)
+        assert cv2_imencode_success
+        return buffer.tobytes()
+
+
+PNG = TileEncoding()
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data)) + kind + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_png8(im: np.ndarray, compression: Optional[int] = None) -> Optional[bytes]:
+    """Encodes a BGRA image as a paletted PNG, or returns None if it has
+    more than 256 distinct colors. The bit depth is the smallest that
+    fits the palette.
+    """
+    h, w = im.shape[:2]
+    packed = np.ascontiguousarray(im, np.uint8).view("<u4").reshape(h * w)
+    codes, palette = pd.factorize(packed)
+    n = len(palette)
+    if n > 256:
+        return None
+    # Alpha is the high byte, so sorting puts the translucent entries
+    # first and lets the tRNS chunk stop at the last of them.
+    order = np.argsort(palette, kind="stable")
+    rank = np.empty(n, np.uint8)
+    rank[order] = np.arange(n)
+    index = rank[codes].reshape(h, w)
+    palette = np.asarray(palette)[order].astype("<u4").view(np.uint8).reshape(n, 4)
+
+    depth = next(d for d in (1, 2, 4, 8) if n <= 2 ** d)
+    if depth < 8:
+        per_byte = 8 // depth
+        padded = np.zeros((h, -(-w // per_byte) * per_byte), np.uint8)
+        padded[:, :w] = index
+        padded = padded.reshape(h, -1, per_byte)
+        index = np.zeros(padded.shape[:2], np.uint8)
+        for k in range(per_byte):
+            index |= padded[:, :, k] << (8 - depth * (k + 1))
+    rows = np.empty((h, index.shape[1] + 1), np.uint8)
+    rows[:, 0] = 0  # filter type None
+    rows[:, 1:] = index
+
+    alpha = palette[:, 3]
+    n_translucent = int((alpha < 255).sum())
+    chunks = [
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, depth, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", palette[:, [2, 1, 0]].tobytes()),
+    ]
+    if n_translucent > 0:
+        chunks.append(_png_chunk(b"tRNS", alpha[:n_translucent].tobytes()))
+    chunks.append(_png_chunk(b"IDAT", zlib.compress(
+        rows.tobytes(), zlib.Z_DEFAULT_COMPRESSION if compression is None else compression
+    )))
+    chunks.append(_png_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+def encode_image(im: np.ndarray, encoding: Optional[TileEncoding] = None) -> bytes:
+    if encoding is None:
+        encoding = PNG
+    return encoding.encode(im)
+
+
+def image_resp(im, encoding=None):
+    if encoding is None:
+        encoding = PNG
+    return flask.Response(encode_image(im, encoding), mimetype=encoding.mimetype)
 
 
 def to_multipolygon(p: Union[Polygon, MultiPolygon]) -> MultiPolygon:
@@ -539,40 +1117,101 @@ def rasterize_multipolygon(
     return im
 
 
-def flatten(im_fg: np.ndarray, im_bg: np.ndarray) -> np.ndarray:
+def flatten(
+    im_fg: np.ndarray, im_bg: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Composites BGRA image `im_fg` over `im_bg` (Porter-Duff "over" of
+    non-premultiplied colors). Both are uint8 or both uint16; the result
+    has their dtype and is written to `out` if given, which may be either
+    of them. Computed in fixed-point integers: int32 for uint8 images,
+    int64 for uint16.
+    """
+    k = np.iinfo(im_bg.dtype).max
+    wide = np.int32 if k == 255 else np.int64
+    if out is None:
+        out = np.empty_like(im_bg)
     # fg = mask
     # bg = unmasked part of the image
     # c = bgr
     # a = alpha = opacity
-    im_fg = im_fg.astype(np.float64) / 255.0
-    im_bg = im_bg.astype(np.float64) / 255.0
-    c_fg = im_fg[:, :, :3]
-    a_fg = im_fg[:, :, 3:]
-    c_bg = im_bg[:, :, :3]
-    a_bg = im_bg[:, :, 3:]
-    a_comp = a_fg + (1.0 - a_fg) * a_bg
-    # Avoid division by zero. If alpha is zero, it doesn't matter what
-    # values b, g, r have; arbitrarily using 1.
-    denom = np.where(a_comp > 0, a_comp, 1)
-    c_comp = (a_fg * c_fg + (1.0 - a_fg) * a_bg * c_bg) / denom
-    im_comp = np.concatenate((c_comp, a_comp), axis=2) * 255.0
-    return im_comp.astype(np.uint8)
+    a_fg = im_fg[:, :, 3:].astype(wide)
+    a_bg = im_bg[:, :, 3:].astype(wide)
+    # composite alpha, in units of 1 / k ** 2
+    a_comp = a_fg * k + (k - a_fg) * a_bg
+    c_comp = a_fg * k * im_fg[:, :, :3] + (k - a_fg) * a_bg * im_bg[:, :, :3]
+    # If alpha is zero, so are the colors' weights; leave them at 0.
+    c_comp //= np.maximum(a_comp, 1)
+    out[:, :, :3] = c_comp
+    out[:, :, 3:] = a_comp // k
+    return out
+
+
+def _mask_color(color: Color, k: int) -> np.ndarray:
+    c = np.array([color.blue, color.green, color.red, color.alpha], np.int64)
+    # colors are 8-bit; k // 255 scales them exactly to uint16
+    return c * (k // 255)
+
+
+def composite_masks(
+    im: np.ndarray, masks: Iterable[Tuple[np.ndarray, Color]]
+) -> np.ndarray:
+    """Paints each `color` over the uint8 or uint16 BGRA image `im` with
+    coverage `mask` (uint8, 0 to 255), for each (mask, color) of `masks`
+    in turn, in place. Returns `im`.
+
+    Pixels a mask doesn't cover are left alone and pixels it fully covers
+    are set to its color, without arithmetic. Only partly covered pixels,
+    along shape edges, are blended, with the formula of `apply_mask`:
+    both the color and the image are scaled by the coverage before
+    compositing. That is fixed-point int64 arithmetic for uint8 images
+    and float64 for uint16, where int64 would overflow.
+    """
+    k = np.iinfo(im.dtype).max
+    for mask, color in masks:
+        c = _mask_color(color, k)
+        if c[3] == 0:
+            # A transparent color leaves nothing of the colors behind.
+            c = np.zeros(4, np.int64)
+        full = mask == 255
+        if full.all():
+            im[:] = c
+            continue
+        im[full] = c
+        edge = (mask != 0) & ~full
+        if not edge.any():
+            continue
+        m = mask[edge].astype(np.int64)[:, np.newaxis]
+        px = im[edge].astype(np.int64)
+        # everything in units of 1 / (k * 255)
+        s = k * 255
+        fg = c * m
+        bg = px * (255 - m)
+        a_fg = fg[:, 3:]
+        a_bg = bg[:, 3:]
+        if k == 255:
+            d = a_fg * s + (s - a_fg) * a_bg
+            n = a_fg * fg[:, :3] * s + (s - a_fg) * a_bg * bg[:, :3]
+            px[:, :3] = k * n // np.maximum(s * d, 1)
+            px[:, 3:] = k * d // (s * s)
+        else:
+            a_fg, a_bg = a_fg / s, a_bg / s
+            a_comp = a_fg + (1 - a_fg) * a_bg
+            c_comp = (a_fg * fg[:, :3] / s + (1 - a_fg) * a_bg * bg[:, :3] / s) / np.where(
+                a_comp > 0, a_comp, 1
+            )
+            px[:, :3] = c_comp * k
+            px[:, 3:] = a_comp * k
+        im[edge] = px
+    return im
 
 
 def apply_mask(
     im: np.ndarray, mask: np.ndarray, mask_color: Color = Color(0, 0, 0, 0)
 ) -> np.ndarray:
-    h = im.shape[0]
-    w = im.shape[1]
-    mask = mask.reshape(mask.shape + (1,)).astype(np.float64) / 255
-    mask_color = np.array(
-        [mask_color.blue, mask_color.green, mask_color.red, mask_color.alpha],
-        np.float64
-    ).reshape((1, 1, 4))
-    im_fg = mask_color * mask
-    im_bg = im * (1.0 - mask)
-    im_comp = flatten(im_fg, im_bg)
-    return im_comp
+    """Paints `mask_color` over a copy of the image `im` with coverage
+    `mask`; see `composite_masks`.
+    """
+    return composite_masks(im.copy(), [(mask, mask_color)])
 
 
 def produce_shape_tile(
@@ -596,6 +1235,7 @@ def produce_shape_tile(
     tile_bounds = (x0, y0, x1, y1)
     tile = MultiPoint([(x0, y0), (x1, y1)]).envelope
 
+    masks = []
     for s, a in shapes:
         mask = np.zeros(im.shape[:2], np.uint8)
         if oper == "difference":
@@ -611,10 +1251,125 @@ def produce_shape_tile(
         fxs = lambda xs: (xs - x0) * x_ratio
         fys = lambda ys: (deg_to_mercator(ys) - y0_mercator) * y_ratio_mercator
         rasterize_multipolygon(mask, mp, fxs, fys, a.line_type, 255, 0)
-        im = apply_mask(im, mask, a.background_color)
+        masks.append((mask, a.background_color))
+
+    return composite_masks(im.copy(), masks)
+
 
-    return im
 
+# Latitude a little beyond the edges of the spherical Mercator tile
+# grid. Shapes and viewports are clamped to it, so that their projection
+# stays finite.
+MERCATOR_LAT_LIMIT = 85.06
+
+
+def _project_normalized(coords: np.ndarray) -> np.ndarray:
+    """Projects (lon, lat) coordinates in degrees to the spherical
+    Mercator tile grid normalized to [0, 1], where tile (tx, ty) at scale
+    z spans [tx, tx + 1] / 2 ** z by [ty, ty + 1] / 2 ** z.
+    """
+    x = (coords[:, 0] + 180) / 360
+    lat = np.clip(coords[:, 1], -MERCATOR_LAT_LIMIT, MERCATOR_LAT_LIMIT)
+    y = (180 - deg_to_mercator(lat)) / 360
+    return np.column_stack((x, y))
+
+
+class ShapeClipper:
+    """Clips tiles to a shape, hiding the pixels outside of it.
+
+    Does the same as `produce_shape_tile` with oper="difference", but the
+    shape is projected to the tile grid once, indexed by an STRtree so
+    that each tile only rasterizes the polygons that cross it, and the
+    mask of each tile is cached. Tiles entirely inside or outside the
+    shape are recognized without rasterizing.
+
+    Parameters
+    ----------
+    shape : Polygon or MultiPolygon
+        the shape in lon/lat degrees
+    color : Color, optional
+        color painted over the pixels outside the shape (default is
+        transparent)
+    line_type : int, optional
+        cv2 line type of the shape's edges (default is cv2.LINE_AA)
+    max_bytes : int, optional
+        memory budget of the mask cache (default is 64 MiB)
+    """
+
+    def __init__(
+        self,
+        shape: Union[Polygon, MultiPolygon],
+        color: Color = Color(0, 0, 0, 0),
+        line_type: int = cv2.LINE_AA,
+        max_bytes: int = 64 * 2**20,
+    ):
+        self.color = color
+        self.line_type = line_type
+        polygons = [
+            shapely.transform(p, _project_normalized)
+            for p in to_multipolygon(shape).geoms
+            if not p.is_empty
+        ]
+        self._tree = shapely.STRtree(polygons)
+        self._rings = [
+            (
+                np.asarray(p.exterior.coords),
+                [np.asarray(q.coords) for q in p.interiors],
+            )
+            for p in polygons
+        ]
+        self._masks = LRUCache(max_bytes, sizeof=lambda m: 64 if m[0] is None else m[0].nbytes)
+
+    def mask(
+        self, tx: int, ty: int, tz: int, width: int = 256, height: int = 256
+    ) -> Optional[np.ndarray]:
+        """Returns the (read-only) uint8 mask of a tile, 255 outside the
+        shape and 0 inside, or None if the tile is entirely inside.
+        """
+        key = (tx, ty, tz, width, height)
+        cached = self._masks.get(key)
+        if cached is None:
+            cached = (self._mask(tx, ty, tz, width, height),)
+            self._masks.put(key, cached)
+        return cached[0]
+
+    def _mask(self, tx, ty, tz, width, height):
+        n = 2 ** tz
+        box = shapely.box(tx / n, ty / n, (tx + 1) / n, (ty + 1) / n)
+        if len(self._tree.query(box, predicate="within")) > 0:
+            return None
+        mask = np.full((height, width), 255, np.uint8)
+        # fixed-point bits of the vertex coordinates, as many as int32
+        # allows at this scale
+        shift = max(0, min(4, 22 - tz))
+        scale = np.array([width * n, height * n]) * 2 ** shift
+        # cv2 puts integer coordinates at pixel centers, half a pixel
+        # into the tile
+        offset = (np.array([tx * width, ty * height]) + 0.5) * 2 ** shift
+        for i in self._tree.query(box, predicate="intersects"):
+            exterior, interiors = self._rings[i]
+            cv2.fillPoly(
+                mask, [(exterior * scale - offset).astype(np.int32)], 0,
+                self.line_type, shift,
+            )
+            for q in interiors:
+                cv2.fillPoly(
+                    mask, [(q * scale - offset).astype(np.int32)], 255,
+                    self.line_type, shift,
+                )
+        mask.setflags(write=False)
+        return mask
+
+    def clip(self, im: np.ndarray, tx: int, ty: int, tz: int) -> Optional[np.ndarray]:
+        """Clips the BGRA tile `im`, in place when possible. Returns the
+        clipped tile, or None if it is entirely transparent.
+        """
+        mask = self.mask(tx, ty, tz, im.shape[1], im.shape[0])
+        if mask is None:
+            return im
+        if self.color.alpha == 0 and (mask == 255).all():
+            return None
+        return composite_masks(im, [(mask, self.color)])
 
 AQUAMARINE = Color(127, 255, 212)
 BLACK = Color(0, 0, 0)
@@ -828,27 +1583,68 @@ def to_dash_colorscale(s: str) -> List[str]:
     return cs
 
 
+_SCRATCH = threading.local()
+
+
+def scratch_buffer(name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+    """Returns an uninitialized array that is reused by later calls from
+    the same thread with the same `name`, `shape` and `dtype`. Callers
+    must not let it escape, since the next call will overwrite it.
+    """
+    buffers = _SCRATCH.__dict__.setdefault("buffers", {})
+    key = (name, tuple(shape), np.dtype(dtype))
+    buf = buffers.get(key)
+    if buf is None:
+        buf = buffers[key] = np.empty(shape, dtype)
+    return buf
+
+
+def pack_bgra(colormap: np.ndarray) -> np.ndarray:
+    """Packs an n-by-BGRA colormap into n+1 little-endian uint32 pixels,
+    whose last entry is the transparent pixel used for missing values.
+    """
+    c = np.clip(colormap, 0, 255).astype(np.uint8)
+    lut = np.empty((len(c) + 1, 4), np.uint8)
+    lut[:-1] = c
+    # transparent, but keeping the color of the lowest level like the
+    # four-band LUT did
+    lut[-1, :3] = c[0, :3]
+    lut[-1, 3] = 0
+    return lut.view("<u4").reshape(len(lut))
+
+
 def apply_colormap(x: np.ndarray, colormap: np.ndarray,
-                   scale_min: float, scale_max: float) -> np.ndarray:
-    im = (
-        (x - scale_min) * 255 /
-        (scale_max- scale_min)
-    ).clip(0, 255)
-
-    # int arrays have no missing value indicator, so record where the
-    # NaNs were before casting to int.
-    mask = np.isnan(im)
-    im[mask] = 0  # an arbitrary value that can be cast to int
-    im = im.astype(np.uint8)
-    im = cv2.merge(
-        [
-            cv2.LUT(im, colormap[:, 0]),
-            cv2.LUT(im, colormap[:, 1]),
-            cv2.LUT(im, colormap[:, 2]),
-            np.where(mask, 0, cv2.LUT(im, colormap[:, 3])),
-        ]
-    )
-    return im
+                   scale_min: float, scale_max: float,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Maps `x` to a BGRA image through a 256-by-BGRA `colormap`,
+    linearly from `scale_min` to `scale_max`. Missing values are
+    transparent.
+
+    Values are quantized in a per-thread scratch buffer and looked up in
+    a packed uint32 table with a single gather into `out` (a new
+    height-by-width-by-4 uint8 array if not given).
+    """
+    lut = pack_bgra(colormap)
+    nan_index = len(lut) - 1
+    if out is None:
+        out = np.empty(x.shape + (4,), np.uint8)
+    dtype = np.result_type(x.dtype, np.float32, scale_min, scale_max)
+    im = scratch_buffer("colormap.scaled", x.shape, dtype)
+    mask = scratch_buffer("colormap.mask", x.shape, np.bool_)
+    index = scratch_buffer("colormap.index", x.shape, np.intp)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.subtract(x, scale_min, out=im, casting="unsafe")
+        np.multiply(im, 255, out=im)
+        np.divide(im, scale_max - scale_min, out=im, casting="unsafe")
+    np.clip(im, 0, 255, out=im)
+    # int arrays have no missing value indicator, so point the NaNs to
+    # the transparent entry before casting to int.
+    np.isnan(im, out=mask)
+    np.copyto(im, nan_index, where=mask)
+    np.copyto(index, im, casting="unsafe")
+    np.take(lut, index, out=out.view("<u4").reshape(x.shape), mode="clip")
+    return out
 
 
 def with_alpha(c: Color, alpha) -> Color:
@@ -880,13 +1676,28 @@ def trim_to_bbox(ds, s, lon_name="lon", lat_name="lat"):
     )
 
 
-def average_over(ds, s, lon_name="lon", lat_name="lat", all_touched=False):
-    """Average a Dataset over a shape"""
-    lon_res = ds[lon_name].values[1] - ds[lon_name].values[0]
-    lat_res = ds[lat_name].values[1] - ds[lat_name].values[0]
+class ShapeMask(NamedTuple):
+    """Weights of the grid cells a shape covers, as computed by
+    `shape_mask`.
+
+    Parameters
+    ----------
+    lon_slice, lat_slice : slice
+        index window of the shape's bounding box in the grid
+    weights : np.ndarray
+        (lat, lon) weights of the cells in the window, the rasterized
+        shape times cos(lat), normalized to sum to 1 (all NaN if the
+        shape covers no cell)
+    """
+    lon_slice: slice
+    lat_slice: slice
+    weights: np.ndarray
 
-    ds = trim_to_bbox(ds, s, lon_name=lon_name, lat_name=lat_name)
 
+def _rasterize_weights(ds, s, lon_res, lat_res, lon_name, lat_name, all_touched):
+    """Rasterizes `s` on the grid of `ds`, trimmed to the shape's bounding
+    box, and weights the cells by cos(lat).
+    """
     lon_min = ds[lon_name].values[0] - 0.5 * lon_res
     lon_max = ds[lon_name].values[-1] + 0.5 * lon_res
     lat_min = ds[lat_name].values[0] - 0.5 * lat_res
@@ -907,23 +1718,244 @@ def average_over(ds, s, lon_name="lon", lat_name="lat", all_touched=False):
     r0 = rasterio.features.rasterize(
         [s], out_shape=(lat_size, lon_size), transform=t, all_touched=all_touched
     )
-    r0 = xr.DataArray(
-        r0,
-        dims=(lat_name, lon_name),
-        coords={lat_name: ds[lat_name], lon_name: ds[lon_name]},
+    return r0 * np.cos(np.deg2rad(ds[lat_name].values))[:, np.newaxis]
+
+
+def shape_mask(ds, s, lon_name="lon", lat_name="lat", all_touched=False) -> ShapeMask:
+    """Returns the ShapeMask of shape `s` on the grid of `ds`. Masks are
+    cached by shape, grid and `all_touched`, so that averaging over the
+    same shape again skips the trimming and rasterization.
+    """
+    lon = np.asarray(ds[lon_name].values, np.float64)
+    lat = np.asarray(ds[lat_name].values, np.float64)
+    grid = Grid.from_coords(lon, lat)
+    key = (
+        hashlib.sha1(shapely.wkb.dumps(s)).hexdigest(),
+        grid,
+        None if grid.regular else hashlib.sha1(lon.tobytes() + lat.tobytes()).hexdigest(),
+        all_touched,
     )
-    r = r0 * np.cos(np.deg2rad(ds[lat_name]))
+    mask = _SHAPE_MASKS.get(key)
+    if mask is None:
+        index = xr.Dataset(
+            {
+                "i": (lon_name, np.arange(len(lon))),
+                "j": (lat_name, np.arange(len(lat))),
+            },
+            coords={lon_name: lon, lat_name: lat},
+        )
+        window = trim_to_bbox(index, s, lon_name, lat_name)
+        i, j = window["i"].values, window["j"].values
+        if len(i) and len(j):
+            r = _rasterize_weights(
+                window, s, lon[1] - lon[0], lat[1] - lat[0], lon_name, lat_name,
+                all_touched,
+            )
+        else:
+            # the shape is outside the grid
+            r = np.zeros((len(j), len(i)))
+        total = r.sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights = r / total if total > 0 else np.full(r.shape, np.nan)
+        weights.setflags(write=False)
+        mask = ShapeMask(
+            slice(i[0], i[-1] + 1) if len(i) else slice(0, 0),
+            slice(j[0], j[-1] + 1) if len(j) else slice(0, 0),
+            weights,
+        )
+        _SHAPE_MASKS.put(key, mask)
+    return mask
+
+
+def _masked_mean(x, weights):
+    """Weighted mean of `x` over its last two axes, skipping NaN."""
+    x = np.asarray(x, np.float64)
+    x = x.reshape(x.shape[:-2] + (-1,))
+    w = weights.ravel()
+    if w.size == 0:
+        return np.full(x.shape[:-1], np.nan)
+    valid = ~np.isnan(x)
+    if valid.all():
+        return x @ w
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(valid, x, 0) @ w / (valid @ w)
+
+
+def _nan_reduced(da, lon_name, lat_name):
+    """An all-NaN float64 `da` reduced over its spatial dimensions, lazy
+    if `da` is. Stands for a reduction over an empty window of `da`,
+    which dask fails to rechunk.
+    """
+    res = xr.full_like(
+        da.isel({lon_name: 0, lat_name: 0}, drop=True), np.nan, dtype=np.float64
+    )
+    res.attrs = {}
+    return res
 
-    res = ds.weighted(r).mean([lat_name, lon_name], skipna=True)
 
-    # For some reason, DataArray names get preserved when they're
-    # inside a Dataset, but not when ds itself is a DataArray.
-    if isinstance(res, xr.DataArray):
+def average_over(ds, s, lon_name="lon", lat_name="lat", all_touched=False):
+    """Average a Dataset over a shape. Variables without both spatial
+    dimensions (e.g. time bounds) are kept as they are."""
+    mask = shape_mask(ds, s, lon_name, lat_name, all_touched)
+    empty = mask.weights.size == 0
+    window = ds if empty else ds.isel(
+        {lon_name: mask.lon_slice, lat_name: mask.lat_slice}
+    )
+
+    def average(da):
+        if lat_name not in da.dims or lon_name not in da.dims:
+            return da
+        if empty:
+            # the shape is outside the grid
+            return _nan_reduced(da, lon_name, lat_name)
+        return xr.apply_ufunc(
+            _masked_mean, da, kwargs={"weights": mask.weights},
+            input_core_dims=[[lat_name, lon_name]],
+            dask="parallelized", output_dtypes=[np.float64],
+            dask_gufunc_kwargs={"allow_rechunk": True},
+        )
+
+    if isinstance(window, xr.Dataset):
+        res = window.map(average)
+    else:
+        res = average(window)
+        # For some reason, DataArray names get preserved when they're
+        # inside a Dataset, but not when ds itself is a DataArray.
         res.name = ds.name
 
     return res
 
 
+ZONAL_STATS = ("mean", "min", "max", "sum")
+
+
+def zonal_stats(
+    ds, shapes, lon_name="lon", lat_name="lat", all_touched=False,
+    stats=ZONAL_STATS, zone_dim="zone", stat_dim="stat",
+):
+    """Summarizes a Dataset or DataArray over each of many shapes at once.
+
+    The shapes' masks (see `shape_mask`) are assembled into sparse zone
+    by cell matrices, so that every statistic of every zone, at every
+    step of the other dimensions, is computed in a single pass over the
+    data.
+
+    Parameters
+    ----------
+    ds : xr.Dataset or xr.DataArray
+        data on a lon/lat grid
+    shapes : dict or sequence of shapely geometries
+        the zones, labeled by the dict's keys or by their position
+    lon_name, lat_name : str
+        names of the spatial dimensions
+    all_touched : bool
+        whether cells touched by a shape's boundary count as inside it
+    stats : sequence of str
+        statistics among "mean" (weighted by cos(lat), as in
+        `average_over`), "min", "max" and "sum" (of the cells inside the
+        zone). Missing values are skipped; a zone without valid cells
+        gets NaN.
+    zone_dim, stat_dim : str
+        names of the new dimensions along zones and statistics
+
+    Returns
+    -------
+    xr.Dataset or xr.DataArray
+        `ds` with its spatial dimensions replaced by `stat_dim` and
+        `zone_dim`; variables of a Dataset without both spatial
+        dimensions (e.g. time bounds) are kept as they are. Without
+        shapes, `zone_dim` is empty.
+    """
+    unknown = set(stats) - set(ZONAL_STATS)
+    if unknown:
+        raise ValueError(f"unknown statistics {sorted(unknown)}")
+    if isinstance(shapes, dict):
+        labels, shapes = list(shapes.keys()), list(shapes.values())
+    else:
+        shapes = list(shapes)
+        labels = list(range(len(shapes)))
+
+    masks = [shape_mask(ds, s, lon_name, lat_name, all_touched) for s in shapes]
+    # the window covering every zone, to read no more than needed
+    i0 = min((m.lon_slice.start for m in masks), default=0)
+    i1 = max((m.lon_slice.stop for m in masks), default=0)
+    j0 = min((m.lat_slice.start for m in masks), default=0)
+    j1 = max((m.lat_slice.stop for m in masks), default=0)
+    n_lon = i1 - i0
+
+    indices = []
+    weights = []
+    for m in masks:
+        jj, ii = np.nonzero(m.weights > 0)
+        cells = (jj + m.lat_slice.start - j0) * n_lon + (ii + m.lon_slice.start - i0)
+        indices.append(cells)
+        weights.append(m.weights[jj, ii])
+    counts = [len(c) for c in indices]
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    indices = np.concatenate(indices) if indices else np.zeros(0, np.int64)
+    weights = np.concatenate(weights) if weights else np.zeros(0)
+    shape = (len(masks), n_lon * (j1 - j0))
+    w = scipy.sparse.csr_matrix((weights, indices, indptr), shape=shape)
+    b = scipy.sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=shape)
+    nonempty = np.diff(indptr) > 0
+
+    def summarize(x):
+        # x is (..., lat, lon); work on (cells, rest)
+        x = np.asarray(x, np.float64)
+        rest = x.shape[:-2]
+        x = x.reshape((int(np.prod(rest)), x.shape[-2] * x.shape[-1])).T
+        valid = ~np.isnan(x)
+        x0 = np.where(valid, x, 0)
+        n_valid = b @ valid
+        result = []
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for stat in stats:
+                if stat == "mean":
+                    r = (w @ x0) / (w @ valid)
+                elif stat == "sum":
+                    r = b @ x0
+                else:
+                    r = np.full((len(masks), x.shape[1]), np.nan)
+                    if nonempty.any():
+                        reduce = np.fmin if stat == "min" else np.fmax
+                        r[nonempty] = reduce.reduceat(
+                            x[indices], indptr[:-1][nonempty], axis=0
+                        )
+                r = np.where(n_valid > 0, r, np.nan)
+                result.append(r.T.reshape(rest + (len(masks),)))
+        return np.stack(result, axis=-1)
+
+    def summarize_da(da):
+        if lat_name not in da.dims or lon_name not in da.dims:
+            return da
+        if empty:
+            return _nan_reduced(da, lon_name, lat_name).expand_dims(
+                {stat_dim: list(stats), zone_dim: labels}
+            )
+        return xr.apply_ufunc(
+            summarize, da,
+            input_core_dims=[[lat_name, lon_name]],
+            output_core_dims=[[zone_dim, stat_dim]],
+            dask="parallelized", output_dtypes=[np.float64],
+            dask_gufunc_kwargs={
+                "allow_rechunk": True,
+                "output_sizes": {zone_dim: len(masks), stat_dim: len(stats)},
+            },
+        ).assign_coords({zone_dim: labels, stat_dim: list(stats)}).transpose(
+            stat_dim, zone_dim, ...
+        )
+
+    # without zones, or with all of them outside the grid, no cell is
+    # read; every statistic is NaN
+    empty = i1 == i0 or j1 == j0
+    window = ds if empty else ds.isel({lon_name: slice(i0, i1), lat_name: slice(j0, j1)})
+    if isinstance(window, xr.Dataset):
+        return window.map(summarize_da)
+    res = summarize_da(window)
+    res.name = ds.name
+    return res
+
+
 #
 # Functions to deal with periodic dimension (e.g. longitude)
 #
@@ -1021,6 +2053,75 @@ def sel_periodic(ds, dim, vals, period=360.0):
 
 
 
+class LRUCache:
+    """A thread-safe mapping that evicts its least recently used entries
+    once the total size of its values exceeds `max_bytes`.
+
+    Parameters
+    ----------
+    max_bytes : int
+        budget for the sum of `sizeof` over all values
+    sizeof : callable, optional
+        size of a value in bytes (default is `len`)
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable = len):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        n = self._sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            if n > self.max_bytes:
+                return
+            self._entries[key] = (value, n)
+            self._size += n
+            while self._size > self.max_bytes:
+                _, (_, m) = self._entries.popitem(last=False)
+                self._size -= m
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# masks of shapes on grids, see shape_mask
+_SHAPE_MASKS = LRUCache(64 * 2**20, sizeof=lambda mask: mask.weights.nbytes + 64)
+
+
 # Flask utils
 
 
@@ -1054,7 +2155,7 @@ def client_side_error(e):
 
 REQUIRED = object()
 
-def parse_arg(name, conversion=str, default=REQUIRED, qstring=None):
+def parse_arg(name, conversion=str, default=REQUIRED, qstring=None, args=None):
     '''Stricter version of flask.request.args.get. Raises an exception in
 cases where args.get ignores the problem and silently falls back on a
 default behavior:
@@ -1062,8 +2163,13 @@ default behavior:
     - if type conversion fails
     - if the same arg is specified multiple times
     - if a required arg is not provided
+
+The args are taken from `args`, a MultiDict, if given, else from
+`qstring`, else from flask.request.args.
     '''
-    if qstring is None:
+    if args is not None:
+        pass
+    elif qstring is None:
         args = flask.request.args
     else:
         if qstring == "":
@@ -1099,15 +2205,47 @@ def fix_calendar(ds):
     return ds
 
 
+def tile_chunks(ds, dim_x="X", dim_y="Y", size=256, max_bytes=64 * 2**20):
+    """Dask chunk sizes for serving `ds` as tiles: `size` cells along X and
+    Y, about the footprint of a tile at the data's native resolution,
+    and as much of the other dimensions, in order, as fits in
+    `max_bytes` per chunk of the widest gridded variable (the one with
+    the most dimensions, then the largest items, among those on X and
+    Y). A tile then reads only the few chunks around it. Pass the result
+    as `chunks` to `open_dataset` or `open_mfdataset`.
+    """
+    chunks = {
+        dim_x: min(size, ds.sizes[dim_x]),
+        dim_y: min(size, ds.sizes[dim_y]),
+    }
+    gridded = [
+        v for v in ds.data_vars.values() if dim_x in v.dims and dim_y in v.dims
+    ]
+    if len(gridded) > 0:
+        widest = max(gridded, key=lambda v: (v.ndim, v.dtype.itemsize))
+        budget = max(
+            1, max_bytes // (chunks[dim_x] * chunks[dim_y] * widest.dtype.itemsize)
+        )
+        for dim in widest.dims:
+            if dim not in chunks:
+                chunks[dim] = min(budget, ds.sizes[dim])
+                budget = max(1, budget // chunks[dim])
+    for dim in ds.dims:
+        chunks.setdefault(dim, -1)
+    return chunks
+
+
 def open_dataset(*args, **kwargs):
     """Open a dataset with xarray, fixing incorrect CF metadata generated
-    by Ingrid."""
+    by Ingrid. To serve tiles from a dask-backed dataset, see
+    `tile_chunks` for chunks aligned with tiles."""
     return _proxy(xr.open_dataset, *args, **kwargs)
 
 
 def open_mfdataset(*args, **kwargs):
     """Open a multi-file dataset with xarray, fixing incorrect CF metadata generated
-    by Ingrid."""
+    by Ingrid. To serve tiles from a dask-backed dataset, see
+    `tile_chunks` for chunks aligned with tiles."""
     return _proxy(xr.open_mfdataset, *args, **kwargs)
 
 
@@ -0,0 +1,56 @@
+import numpy as np
+import xarray as xr
+from shapely.geometry import box
+
+import pingrid
+
+STATS = ["mean", "min", "max", "sum"]
+
+
+def _grid_data(*extra_dims):
+    shape = tuple(n for _, n in extra_dims) + (3, 4)
+    return xr.DataArray(
+        np.arange(np.prod(shape), dtype=np.float64).reshape(shape),
+        coords={"lat": [0.0, 1.0, 2.0], "lon": [0.0, 1.0, 2.0, 3.0]},
+        dims=tuple(d for d, _ in extra_dims) + ("lat", "lon"),
+        name="x",
+    )
+
+
+def test_zonal_stats_no_shapes():
+    res = pingrid.zonal_stats(_grid_data(), [])
+    assert dict(res.sizes) == {"stat": len(STATS), "zone": 0}
+    assert list(res["stat"].values) == STATS
+    assert res.name == "x"
+
+
+def test_zonal_stats_no_shapes_keeps_other_dims():
+    ds = xr.Dataset({"x": _grid_data(("T", 5)), "n": ("T", np.arange(5))})
+    for data in (ds, ds.chunk({"T": 2})):
+        res = pingrid.zonal_stats(data, {})
+        assert dict(res["x"].sizes) == {"stat": len(STATS), "zone": 0, "T": 5}
+        assert (res["n"] == ds["n"]).all()
+
+
+def test_zonal_stats_shapes_outside_grid():
+    da = _grid_data(("T", 5))
+    for data in (da, da.chunk({"T": 2})):
+        res = pingrid.zonal_stats(data, {"a": box(50, 50, 51, 51)})
+        assert dict(res.sizes) == {"stat": len(STATS), "zone": 1, "T": 5}
+        assert list(res["zone"].values) == ["a"]
+        assert res.isnull().all()
+
+
+def test_average_over_shape_outside_grid():
+    da = _grid_data(("T", 5))
+    for data in (da, da.chunk({"T": 2})):
+        res = pingrid.average_over(data, box(50, 50, 51, 51))
+        assert dict(res.sizes) == {"T": 5}
+        assert res.name == "x"
+        assert res.isnull().all()
+
+
+def test_tile_row_mercator_poles():
+    for tz in (0, 1, 5):
+        assert pingrid.tile_row_mercator(90, tz) == 0
+        assert pingrid.tile_row_mercator(-90, tz) == 2 ** tz - 1
@@ -0,0 +1,153 @@
+"""Extraction of time series at marker positions.
+
+Output panels driven by a marker pull the series of the grid cell under
+it out of a dataset. `PointExtractor` resolves a position to its cell in
+constant time from the dataset's `pingrid.Grid`, instead of searching
+the coordinates with `sel_snap` on every call, and keeps the series of
+recently requested cells in memory, so moving a marker back and forth
+only reads each cell once.
+
+Datasets chunked for maps (large X/Y blocks, few time steps per chunk)
+are slow to read along time. A copy rechunked for series, each chunk
+holding the whole time axis of a small block of cells, can be built
+with
+
+    python points.py data.nc data.points.zarr
+
+and registered with `PointExtractor.add_copy` (`Maproom.points` is the
+extractor behind `Maproom.point_series`). It is read instead of the
+original for as long as it was built from the current version of the
+original.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+import pingrid
+from common import DATASETS, DatasetPool, MaproomException, file_version
+
+COPIES = DatasetPool(opener=xr.open_zarr)
+
+
+class PointExtractor:
+    """Extracts the series of the grid cell at a position from datasets
+    in `common.DATASETS`, keeping up to `max_bytes` of recently
+    extracted series in memory.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self._series = pingrid.LRUCache(max_bytes, sizeof=lambda da: da.nbytes)
+        self._copies = dict()
+
+    def add_copy(self, path, copy):
+        """Reads series of the dataset at `path` from `copy`, a copy of
+        it rechunked for series (see `rechunk`), when it is up to date.
+        """
+        self._copies[path] = copy
+
+    def clear(self):
+        self._series.clear()
+
+    def _source(self, path):
+        entry = DATASETS.get(path)
+        copy = self._copies.get(path)
+        if copy is not None and os.path.exists(copy):
+            copy_entry = COPIES.get(copy)
+            source_version = copy_entry['data'].attrs.get("source_version")
+            if (
+                source_version is not None
+                and tuple(source_version) == entry['version']
+            ):
+                return entry['version'], copy_entry
+        return entry['version'], entry
+
+    def series(self, path, position, variable=None):
+        """Returns the data of the dataset at `path` (its variable
+        `variable` if given) in the grid cell nearest to the marker
+        `position`, [lat, lng] or {"lat": lat, "lng": lng}.
+
+        Raises MaproomException if the position is outside the grid.
+        """
+        if isinstance(position, dict):
+            lat, lng = position["lat"], position["lng"]
+        else:
+            lat, lng = position
+        version, entry = self._source(path)
+        grid = entry['grid']
+        if grid is None:
+            raise MaproomException(f"`{path}` has no X and Y coordinates")
+
+        if grid.regular:
+            cell = grid.cell(lng, lat)
+        else:
+            cell = _search_cell(entry['data'], lng, lat)
+        if cell is None:
+            raise MaproomException(f"({lat}, {lng}) is outside of `{path}`")
+
+        key = (path, variable, version) + cell
+        result = self._series.get(key)
+        if result is None:
+            data = entry['data'] if variable is None else entry['data'][variable]
+            result = data.isel(X=cell[0], Y=cell[1]).load()
+            self._series.put(key, result)
+        return result
+
+
+def _search_cell(data, x, y):
+    xs = data["X"].values
+    ys = data["Y"].values
+    if not (
+        min(xs[0], xs[-1]) <= x <= max(xs[0], xs[-1])
+        and min(ys[0], ys[-1]) <= y <= max(ys[0], ys[-1])
+    ):
+        return None
+    return int(np.abs(xs - x).argmin()), int(np.abs(ys - y).argmin())
+
+
+def rechunk(path, out, block=16):
+    """Writes a copy of the dataset at `path` to the Zarr store `out`,
+    chunked for reading series: each chunk holds the whole of the
+    non-spatial dimensions for `block` x `block` cells. Replaces any
+    previous copy. Returns `out`.
+    """
+    with xr.open_dataset(path) as ds:
+        chunks = {d: -1 for d in ds.dims}
+        chunks.update(X=block, Y=block)
+        ds = ds.chunk(chunks)
+        for v in ds.variables.values():
+            v.encoding.pop("chunks", None)
+            v.encoding.pop("preferred_chunks", None)
+        version = file_version(path)
+        ds.attrs["source_version"] = None if version is None else list(version)
+
+        parent = os.path.dirname(os.path.abspath(out))
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            ds.to_zarr(os.path.join(tmp, "copy.zarr"), mode="w")
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.replace(os.path.join(tmp, "copy.zarr"), out)
+    os.rmdir(tmp)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Copy a dataset rechunked for reading time series",
+    )
+    parser.add_argument("path", help="dataset to copy")
+    parser.add_argument("out", help="Zarr store to write")
+    parser.add_argument("--block", type=int, default=16,
+                        help="cells along X and Y per chunk (default 16)")
+    args = parser.parse_args(argv)
+    print(rechunk(args.path, args.out, args.block))
+
+
+if __name__ == "__main__":
+    main()
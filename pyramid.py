@@ -0,0 +1,208 @@
+"""Precomputed multi-resolution overviews ("pyramids") of map layers.
+
+A pyramid holds the result of a layer function for one set of control
+values at the native resolution and coarsened by 2, 4, 8, ... along X
+and Y, each level a Zarr store. Tiles at low zoom are then read from the
+coarsest level that is still at least as fine as the tile's pixels,
+instead of resampling a huge slice of the native grid.
+
+Build one from the command line with
+
+    python pyramid.py my_maproom:mr "Layer label" month=January --out pyramids/
+
+or from Python with `Maproom.build_pyramid`.
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from inspect import signature
+
+import numpy as np
+import xarray as xr
+
+import pingrid
+from common import DATASETS, DatasetPool, MaproomException, dask_scheduler, file_version, grid_of
+
+MANIFEST = "pyramid.json"
+
+LEVELS = DatasetPool(opener=xr.open_zarr)
+
+_MANIFESTS = pingrid.LRUCache(1024, sizeof=lambda m: 1)
+
+
+def store_path(directory, params):
+    """Where the pyramid of a layer for control values `params` (a dict) is
+    stored under `directory`.
+    """
+    key = repr(tuple(sorted((k, str(v)) for k, v in params.items())))
+    return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+
+
+def encode_attrs(attrs):
+    result = {}
+    for k, v in attrs.items():
+        if isinstance(v, pingrid.ColorScale):
+            v = {
+                "__colorscale__": {
+                    "name": v.name,
+                    "colors": v.colors.tolist(),
+                    "scale": list(v.scale),
+                }
+            }
+        elif isinstance(v, np.generic):
+            v = v.item()
+        result[k] = v
+    return result
+
+
+def decode_attrs(attrs):
+    result = {}
+    for k, v in attrs.items():
+        if isinstance(v, dict) and "__colorscale__" in v:
+            cs = v["__colorscale__"]
+            v = pingrid.ColorScale(
+                cs["name"], [pingrid.Color(*c) for c in cs["colors"]], cs["scale"]
+            )
+        result[k] = v
+    return result
+
+
+def _coarsen(da):
+    """Halves the resolution of `da` along X and Y, averaging 2x2 blocks
+    and padding odd sizes with a missing cell.
+    """
+    for dim in ("X", "Y"):
+        c = da[dim].values
+        if len(c) % 2 == 1:
+            da = da.reindex({dim: np.append(c, c[-1] + (c[-1] - c[-2]))})
+    return da.coarsen(X=2, Y=2).mean()
+
+
+def build(path, function, params, directory, chunks=None, scheduler=None):
+    """Evaluates `function` on the dataset at `path` with control values
+    `params` (a dict keyed by parameter name) and stores its pyramid
+    under `directory`, replacing any previous one.
+
+    Returns the path of the pyramid.
+    """
+    names = list(signature(function).parameters.keys())[1:]
+    missing = set(names) - set(params)
+    if missing:
+        raise MaproomException(f"missing values for {sorted(missing)}")
+    # control values reach layer functions as strings
+    args = [str(params[p]) for p in names]
+
+    entry = DATASETS.get(path, chunks)
+    result = function(entry['data'], *args).compute(
+        scheduler=dask_scheduler(scheduler)
+    )
+    grid = grid_of(result)
+    if grid is None or not grid.regular:
+        raise MaproomException("pyramids need a result on a regular X/Y grid")
+    attrs = encode_attrs(result.attrs)
+    da = result.transpose("Y", "X").astype(np.float32)
+    da.attrs = {}
+    da.name = "value"
+
+    os.makedirs(directory, exist_ok=True)
+    target = store_path(directory, dict(zip(names, args)))
+    tmp = tempfile.mkdtemp(dir=directory)
+    try:
+        resolutions = []
+        level = 0
+        while True:
+            da.to_dataset().to_zarr(os.path.join(tmp, f"{level}.zarr"), mode="w")
+            resolutions.append(abs(float(da["X"][1] - da["X"][0])))
+            if min(da.sizes["X"], da.sizes["Y"]) < 4:
+                break
+            da = _coarsen(da)
+            level += 1
+        with open(os.path.join(tmp, MANIFEST), "w") as f:
+            json.dump({
+                "params": dict(zip(names, args)),
+                "resolutions": resolutions,
+                "attrs": attrs,
+                "source_version": entry['version'],
+            }, f)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    if os.path.exists(target):
+        old = tempfile.mkdtemp(dir=directory)
+        os.replace(target, os.path.join(old, "pyramid"))
+        os.replace(tmp, target)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, target)
+    return target
+
+
+def _manifest(store):
+    manifest_path = os.path.join(store, MANIFEST)
+    version = file_version(manifest_path)
+    if version is None:
+        return None
+    key = (manifest_path, version)
+    manifest = _MANIFESTS.get(key)
+    if manifest is None:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest["attrs"] = decode_attrs(manifest["attrs"])
+        _MANIFESTS.put(key, manifest)
+    return manifest
+
+
+def overviews(directory, params):
+    """Makes the lookup `tile_wrap` uses to read tiles from the pyramids
+    under `directory` of a layer with parameter names `params`.
+
+    The lookup takes the control values, the tile's zoom level and the
+    version of the layer's dataset, and returns the level to draw from
+    as a (DataArray, Grid) pair, or None if there is no pyramid for
+    those control values or it was built from another version of the
+    data.
+    """
+    def lookup(args, tz, version):
+        store = store_path(directory, dict(zip(params, args)))
+        manifest = _manifest(store)
+        if manifest is None:
+            return None
+        source_version = manifest["source_version"]
+        if (None if source_version is None else tuple(source_version)) != version:
+            return None
+        pixel = 360.0 / 2 ** tz / 256
+        level = 0
+        for k, res in enumerate(manifest["resolutions"]):
+            if res <= pixel:
+                level = k
+        entry = LEVELS.get(os.path.join(store, f"{level}.zarr"))
+        da = entry['data']["value"].assign_attrs(manifest["attrs"])
+        return da, entry['grid']
+    return lookup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Precompute the pyramid of a maproom layer",
+    )
+    parser.add_argument("maproom", help="module:variable of the Maproom")
+    parser.add_argument("layer", help="label of the layer")
+    parser.add_argument("params", nargs="*", help="control values as name=value")
+    parser.add_argument("--out", help="pyramid directory (default is the layer's)")
+    args = parser.parse_args(argv)
+
+    module_name, _, variable = args.maproom.partition(":")
+    sys.path.insert(0, os.getcwd())
+    maproom = getattr(importlib.import_module(module_name), variable or "mr")
+    params = dict(p.split("=", 1) for p in args.params)
+    print(maproom.build_pyramid(args.layer, params, args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Pre-rendering ("seeding") of map tiles into a Maproom's tile cache.
+
+Seeding renders every tile of a layer over a bounding box, a range of
+zoom levels and a set of control values through the same route that
+serves them, so that they are cached before users ask for them, e.g.
+right after a forecast release. Tiles are rendered in parallel by a pool
+of processes, and a journal of the finished tiles lets an interrupted
+run resume where it stopped.
+
+From the command line:
+
+    python seed.py my_maproom:mr 0 --bbox 27 -31 30 -28 --zooms 4 9 \
+        --param month=January,February --processes 8 --journal seed.log
+"""
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import urllib.parse
+
+import flask
+
+import pingrid
+from common import DATASETS, MaproomException
+
+_CLIENT = None
+
+
+def tiles_in_bbox(bbox, zooms):
+    """Yields the (tz, tx, ty) of the tiles overlapping `bbox`, given as
+    (lon_min, lat_min, lon_max, lat_max), at each zoom level in `zooms`.
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    for tz in zooms:
+        for tx in range(pingrid.tile_column(lon_min, tz), pingrid.tile_column(lon_max, tz) + 1):
+            # row numbers increase as latitude decreases
+            for ty in range(pingrid.tile_row_mercator(lat_max, tz), pingrid.tile_row_mercator(lat_min, tz) + 1):
+                yield tz, tx, ty
+
+
+def tile_urls(layer, bbox, zooms, params_list):
+    """The URLs of the tiles of layer number `layer` to seed, one per tile
+    and dict of control values in `params_list`.
+    """
+    for params in params_list:
+        qstr = urllib.parse.urlencode(params)
+        for tz, tx, ty in tiles_in_bbox(bbox, zooms):
+            yield f"/tile-{layer}/{tz}/{tx}/{ty}?{qstr}"
+
+
+def _init_worker(maproom):
+    global _CLIENT
+    # Dataset handles inherited from the parent process must not be shared.
+    DATASETS.clear()
+    server = flask.Flask(__name__)
+    maproom.render(server)
+    _CLIENT = server.test_client()
+
+
+def _render(url):
+    resp = _CLIENT.get(url)
+    return url, resp.status_code
+
+
+def _read_journal(path):
+    if path is None or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.rstrip("\n") for line in f}
+
+
+def seed(maproom, layer, bbox, zooms, params_list, processes=None,
+         journal=None, progress=True):
+    """Renders the tiles of layer number `layer` of `maproom` into its tile
+    cache.
+
+    Parameters
+    ----------
+    maproom : Maproom
+        the maproom whose tile cache is filled
+    layer : int
+        index of the layer, in the order the layers were added
+    bbox : tuple of float
+        (lon_min, lat_min, lon_max, lat_max) of the area to seed
+    zooms : iterable of int
+        zoom levels to seed
+    params_list : list of dict
+        control values to seed, one dict per combination
+    processes : int, optional
+        number of rendering processes (default is one per CPU). Each
+        process has its own memory tier, so a tile cache without a
+        directory is always seeded by this process alone.
+    journal : str, optional
+        file recording finished tiles; tiles already recorded are skipped,
+        which resumes an interrupted run
+    progress : bool, optional
+        report progress on stderr (default is True)
+
+    Returns
+    -------
+    list of (str, int)
+        the URL and status of each tile that failed to render
+    """
+    if not 0 <= layer < len(maproom._layers):
+        raise MaproomException(f"there is no layer number {layer}")
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if maproom.tile_cache.directory is None:
+        processes = 1
+
+    done = _read_journal(journal)
+    urls = [u for u in tile_urls(layer, bbox, zooms, params_list) if u not in done]
+    total = len(urls)
+    failures = []
+    log = open(journal, "a") if journal is not None else None
+    start = time.monotonic()
+    try:
+        if processes > 1:
+            ctx = multiprocessing.get_context("fork")
+            pool = ctx.Pool(processes, initializer=_init_worker, initargs=(maproom,))
+            results = pool.imap_unordered(_render, urls, chunksize=8)
+        else:
+            pool = None
+            _init_worker(maproom)
+            results = map(_render, urls)
+        for n, (url, status) in enumerate(results, 1):
+            if status in (200, 304):
+                if log is not None:
+                    log.write(url + "\n")
+                    log.flush()
+            else:
+                failures.append((url, status))
+            if progress:
+                elapsed = time.monotonic() - start
+                print(
+                    f"\rseeded {n}/{total} tiles, {len(failures)} failed,"
+                    f" {n / elapsed if elapsed > 0 else 0:.1f} tiles/s",
+                    end="", file=sys.stderr, flush=True,
+                )
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if log is not None:
+            log.close()
+        if progress:
+            print(file=sys.stderr)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the tile cache of a maproom")
+    parser.add_argument("maproom", help="module:variable of the Maproom")
+    parser.add_argument("layer", type=int, help="index of the layer")
+    parser.add_argument("--bbox", type=float, nargs=4, required=True,
+                        metavar=("LON_MIN", "LAT_MIN", "LON_MAX", "LAT_MAX"))
+    parser.add_argument("--zooms", type=int, nargs=2, required=True,
+                        metavar=("MIN", "MAX"))
+    parser.add_argument("--param", action="append", default=[],
+                        help="name=v1,v2,... control values to seed, all combinations")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--journal")
+    args = parser.parse_args(argv)
+
+    module_name, _, variable = args.maproom.partition(":")
+    sys.path.insert(0, os.getcwd())
+    maproom = getattr(importlib.import_module(module_name), variable or "mr")
+    if maproom.tile_cache.directory is None:
+        # the memory tier of this process ends with it
+        parser.error(
+            f"the tile cache of {args.maproom} has no directory,"
+            " so there is nothing to seed for the server"
+        )
+    names, values = [], []
+    for p in args.param:
+        name, _, vs = p.partition("=")
+        names.append(name)
+        values.append(vs.split(","))
+    params_list = [dict(zip(names, vs)) for vs in itertools.product(*values)]
+    failures = seed(
+        maproom, args.layer, args.bbox, range(args.zooms[0], args.zooms[1] + 1),
+        params_list, args.processes, args.journal,
+    )
+    for url, status in failures:
+        print(f"{status} {url}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,4 +9,9 @@ setup(
     description='Maprooms',
     packages=find_packages(),
     install_requires=[],
+    # optional servers, see Maproom.serve and Maproom.asgi
+    extras_require={
+        'serve': ['gunicorn'],
+        'asgi': ['asgiref'],
+    },
 )
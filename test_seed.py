@@ -0,0 +1,11 @@
+import seed
+
+
+def test_tiles_in_global_bbox():
+    tiles = list(seed.tiles_in_bbox((-180, -90, 180, 90), [0, 1, 2]))
+    assert tiles == [
+        (tz, tx, ty)
+        for tz in (0, 1, 2)
+        for tx in range(2 ** tz)
+        for ty in range(2 ** tz)
+    ]
@@ -0,0 +1,187 @@
+"""Vector overlays: shapes sent to the browser as GeoJSON and drawn there.
+
+Boundaries rasterized into image tiles are redrawn for every tile, zoom
+level and colormap. Sending them as vectors instead costs one download
+per zoom level, and the browser draws them over any layer. Shapes are
+simplified to the resolution of each zoom level, so that a country's
+coastline is not shipped at full detail to a zoomed out map.
+
+Each overlay is served both as one GeoJSON document per zoom level at
+/vector-{i}/{z}, and as GeoJSON tiles at /vector-{i}/{z}/{x}/{y} holding
+the outlines of the shapes clipped to the tile (plus a margin); outlines
+rather than shapes, so that clipping adds no edges. The map of
+`Maproom.render` loads the documents at low zoom levels, and from
+TILE_ZOOM on the tiles in view (see `urls`), so that zooming in doesn't
+ship every shape at full detail. Both go through the Maproom's tile
+cache.
+"""
+import hashlib
+import json
+
+import numpy as np
+import shapely
+
+import pingrid
+
+MIMETYPE = "application/geo+json"
+
+# zoom levels served, as in Leaflet's default tile layers
+MAX_ZOOM = 22
+
+# zoom level from which the map loads tiles instead of documents, and
+# the most tiles it loads at once
+TILE_ZOOM = 8
+MAX_TILES = 64
+
+# zoom level beyond which shapes are no longer simplified further; at
+# the default tolerance its pixel is about a meter
+SIMPLIFY_MAX_ZOOM = 16
+
+
+class VectorLayer:
+    """Shapes to serve as GeoJSON, simplified by zoom level.
+
+    Parameters
+    ----------
+    shapes : shapely geometry, sequence of geometries, or dict
+        the shapes; a dict maps names, kept as the features' "name"
+        property, to geometries
+    tolerance : float, optional
+        simplification tolerance in pixels (default is 0.5)
+    margin : int, optional
+        pixels of shape kept around tiles, so that the lines of
+        neighbouring tiles join (default is 8)
+    max_bytes : int, optional
+        memory budget of the simplified shapes (default is 64 MiB)
+    """
+    def __init__(self, shapes, tolerance=0.5, margin=8, max_bytes=64 * 2**20):
+        if isinstance(shapes, dict):
+            names = list(shapes.keys())
+            geoms = list(shapes.values())
+        elif isinstance(shapes, shapely.Geometry):
+            names = [None]
+            geoms = [shapes]
+        else:
+            geoms = list(shapes)
+            names = [None] * len(geoms)
+        self.tolerance = tolerance
+        self.margin = margin
+        self._geoms = np.array(geoms, dtype=object)
+        self._properties = [
+            json.dumps({} if n is None else {"name": n}) for n in names
+        ]
+        self._tree = shapely.STRtree(self._geoms)
+        self._simplified = pingrid.LRUCache(
+            max_bytes, sizeof=lambda geoms: 16 * int(shapely.get_num_coordinates(geoms).sum())
+        )
+        # identifies the shapes in cache keys
+        self.version = hashlib.sha1(
+            b"".join(shapely.to_wkb(self._geoms)) + repr(names).encode()
+        ).hexdigest()
+
+    def _pixel(self, tz):
+        # size in degrees of a pixel at the equator
+        return 360.0 / 2 ** tz / 256
+
+    def simplified(self, tz):
+        """The shapes simplified for zoom level `tz`, at most
+        SIMPLIFY_MAX_ZOOM, computed once per level.
+        """
+        tz = min(tz, SIMPLIFY_MAX_ZOOM)
+        geoms = self._simplified.get(tz)
+        if geoms is None:
+            geoms = shapely.simplify(
+                self._geoms, self.tolerance * self._pixel(tz), preserve_topology=True
+            )
+            self._simplified.put(tz, geoms)
+        return geoms
+
+    def _collection(self, indices, geoms):
+        features = [
+            '{"type": "Feature", "geometry": %s, "properties": %s}'
+            % (shapely.to_geojson(g), self._properties[i])
+            for i, g in zip(indices, geoms)
+            if not g.is_empty
+        ]
+        return (
+            '{"type": "FeatureCollection", "features": [%s]}' % ", ".join(features)
+        ).encode()
+
+    def zoom(self, tz):
+        """GeoJSON of all the shapes, simplified for zoom level `tz`."""
+        return self._collection(range(len(self._geoms)), self.simplified(tz))
+
+    def tile(self, tz, tx, ty):
+        """GeoJSON of the outlines of the shapes within tile (tx, ty) at
+        zoom level `tz`, simplified for that level and clipped to the
+        tile plus margin.
+        """
+        pad = self.margin / 256
+        x_min = pingrid.tile_left(tx - pad, tz)
+        x_max = pingrid.tile_left(tx + 1 + pad, tz)
+        # row numbers increase as latitude decreases
+        y_max = pingrid.tile_top_mercator(max(ty - pad, 0), tz)
+        y_min = pingrid.tile_top_mercator(min(ty + 1 + pad, 2 ** tz), tz)
+        indices = self._tree.query(shapely.box(x_min, y_min, x_max, y_max))
+        indices.sort()
+        geoms = self.simplified(tz)[indices]
+        polygonal = shapely.get_dimensions(geoms) == 2
+        geoms[polygonal] = shapely.boundary(geoms[polygonal])
+        geoms = shapely.clip_by_rect(geoms, x_min, y_min, x_max, y_max)
+        return self._collection(indices, geoms)
+
+
+def urls(prefix, zoom, bounds, tiled=True):
+    """The URLs of what the map should load of the overlay served at
+    `prefix` for the viewport `bounds` ([[south, west], [north, east]])
+    at zoom level `zoom`: the tiles in view from TILE_ZOOM on if
+    `tiled` and there are at most MAX_TILES of them, the document of the
+    zoom level otherwise.
+    """
+    zoom = 0 if zoom is None else min(max(int(zoom), 0), MAX_ZOOM)
+    if not tiled or zoom < TILE_ZOOM or bounds is None:
+        return [f"{prefix}/{zoom}"]
+    (south, west), (north, east) = bounds
+    south = max(south, -pingrid.MERCATOR_LAT_LIMIT)
+    north = min(north, pingrid.MERCATOR_LAT_LIMIT)
+    rows = range(
+        pingrid.tile_row_mercator(north, zoom),
+        pingrid.tile_row_mercator(south, zoom) + 1,
+    )
+    columns = range(
+        pingrid.tile_column(west, zoom), pingrid.tile_column(east, zoom) + 1
+    )
+    if len(rows) * len(columns) > MAX_TILES:
+        return [f"{prefix}/{zoom}"]
+    return [f"{prefix}/{zoom}/{tx}/{ty}" for ty in rows for tx in columns]
+
+
+def vector_wrap(layer, cache, name):
+    """Makes the view functions serving the tiles and the zoom levels of
+    the VectorLayer `layer` through the TileCache `cache`.
+    """
+    def serve(key, produce):
+        digest = cache.digest((name, layer.version) + key)
+        buf = cache.get(digest)
+        if buf is None:
+            buf = produce()
+            cache.put(digest, buf)
+        return cache.response(digest, buf, MIMETYPE)
+
+    def tile(tz, tx, ty):
+        if not (tz <= MAX_ZOOM and 0 <= tx < 2 ** tz and 0 <= ty < 2 ** tz):
+            return pingrid.client_side_error(
+                pingrid.NotFoundError(f"there is no tile {tz}/{tx}/{ty}")
+            )
+        return serve((tz, tx, ty), lambda: layer.tile(tz, tx, ty))
+
+    def zoom(tz):
+        if tz > MAX_ZOOM:
+            return pingrid.client_side_error(
+                pingrid.NotFoundError(f"there is no zoom level {tz}")
+            )
+        # levels past SIMPLIFY_MAX_ZOOM share a document
+        tz = min(tz, SIMPLIFY_MAX_ZOOM)
+        return serve((tz,), lambda: layer.zoom(tz))
+
+    return tile, zoom